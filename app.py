@@ -1,26 +1,465 @@
+import io
 import os
+import re
 import math
+import time
+import queue
+import random
 import json
+import zlib
 import base64
 import sqlite3
+import array
+import bisect
+import heapq
 import hashlib
+import itertools
+import collections
+import threading
+import mimetypes
 from functools import wraps
+from concurrent.futures import Future, ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
 from flask import (
-    Flask, render_template, g, request,
+    Flask, Blueprint, current_app, render_template, g, request, has_app_context,
+    has_request_context, copy_current_request_context,
     session, flash, redirect, url_for,
-    json, jsonify,
+    json, jsonify, make_response, Response, stream_with_context,
 )
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # without Pillow no variants are made, listings show the uploaded image
+    Image = None
+try:
+    import numpy
+except ImportError:  # without NumPy search_shops computes distances in SQL
+    numpy = None
+
 sqlite3.enable_callback_tracebacks(True)
 
 DATABASE = "HWDB.db"
 SCHEMA = 'schema.sql'
 
+# applied once to every pooled connection, see _connect
+SQLITE_PRAGMAS = {
+    # WAL lets readers run while a write is in progress
+    'journal_mode': 'WAL',
+    'busy_timeout': 10000,  # ms
+    'foreign_keys': 'ON',
+    'cache_size': -16000,  # negative means KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    # durable enough with WAL, FULL would sync on every commit
+    'synchronous': 'NORMAL',
+}
+# prepared statements kept by each connection (sqlite3 default is 128)
+SQLITE_STATEMENT_CACHE = 512
+# threads of the server of python app.py, each keeps its pooled connection for every request it answers
+SERVER_THREADS = 16
+
+# send write_transaction jobs to a single writer thread that commits them in batches
+# off by default: with WAL and synchronous=NORMAL commits don't sync, so batching saves little and the handoff
+# to the writer costs more (bench/write_throughput.py), and the writer only serializes writes of its own process
+SERIALIZED_WRITES = False
+# at most this many jobs share one commit
+WRITE_BATCH_SIZE = 64
+
+# credit shop owners through Pending_Credits, added to U_balance by settle_balances every SETTLEMENT_INTERVAL
+# seconds, so orders of a busy store don't all update the owner's Users row
+DEFERRED_SETTLEMENT = True
+SETTLEMENT_INTERVAL = 5  # s
+
 # distance boundary
 DISTANCE_BOUNDARY = {'medium': 200, 'far': 600}
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(99)
+# approximate radius of earth in km
+EARTH_RADIUS = 6373.0
+
+# search_shops buckets stores by the dot product of unit vectors (S_x, S_y, S_z) in SQL,
+# instead of calling _GIO_DIS for each store
+SQL_DISTANCE = True
+# stores whose dot product is this close to a boundary are bucketed by _GIO_DIS, so rounding errors
+# never put a store in another bucket
+SQL_DISTANCE_MARGIN = 1e-10
+
+# search_shops computes the distance of every store with NumPy (if installed) in one vectorized call, see
+# _StoreLocations, and only passes the stores it needs to SQL
+NUMPY_DISTANCE = True
+
+# search_shops joins Products in one query instead of calling search_menu per store,
+# slower than search_menu once its menu cache (MENU_CACHE_SIZE) is warm
+SEARCH_SINGLE_PASS = False
+
+# Products columns sent to nav.html, P_image is served by product_image instead
+MENU_COLUMNS = 'PID, P_name, P_price, P_quantity, P_imagetype, P_image_hash, P_thumb_hash, P_owner, P_store'
+
+# menus of this many stores are kept in memory by search_menu, least recently used ones are dropped first
+# 0 disables the cache
+MENU_CACHE_SIZE = 4096
+# price-sorted arrays of product prices of this many stores are kept by search_menu, stores without a product in
+# the price range of a search are skipped before their menu is read, 0 disables them
+PRICE_CACHE_SIZE = 65536
+
+# search_shops results are kept for SEARCH_CACHE_TTL seconds (0 disables the cache), at most SEARCH_CACHE_SIZE
+# of them, least recently used ones are dropped first
+# users in the same SEARCH_CACHE_CELL degree grid cell share results, they are searched from the center of the cell
+SEARCH_CACHE_TTL = 5  # s
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_CELL = 0.001  # degree, about 110 m
+# results expired for less than SEARCH_CACHE_STALE seconds are still returned while a background thread
+# searches again, so a busy database doesn't slow popular searches down, 0 disables it
+SEARCH_CACHE_STALE = 0  # s
+
+# size of generated product image variants, cropped to fill their box
+# only variants something links to are made, pages show the uploaded image everywhere else
+IMAGE_VARIANTS = {'thumb': (144, 144)}
+
+# product image urls contain the image hash, so browsers may cache them forever
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# transaction records returned by one search_transactionRecord call, by default and at most
+TRANSACTION_PAGE_SIZE = 50
+TRANSACTION_PAGE_MAX = 500
+
+# compress Orders.O_details with zlib when that makes it smaller
+ORDER_DETAILS_ZLIB = True
+
+# O_status of the status filter of order histories
+ORDER_STATUS = {'Not finished': 0, 'Finished': 1, 'Canceled': -1}
+# orders returned by one search_MyOrders / search_ShopOrders call, by default and at most
+ORDER_PAGE_SIZE = 50
+ORDER_PAGE_MAX = 500
+
+# columns search_shops can be ordered by (keys are sent by nav.html)
+SHOP_ORDERING = {'S_name': 'S_name', 'S_foodtype': 'S_foodtype', 'manhattan': 'dis_rank'}
+
+# shops returned by nearest_shops, by default and at most
+NEAREST_SHOPS_K = 20
+NEAREST_SHOPS_MAX = 100
+# radius of the first box nearest_shops reads around the user, doubled until K shops are found
+NEAREST_SHOPS_RADIUS = 2  # km
+
+# record latency and SQL metrics of requests, served in Prometheus text format by /metrics
+# metrics are kept per process, every gunicorn worker has its own
+METRICS = True
+# upper bounds of histogram buckets, in seconds and in statements
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# slow query log: time this fraction of SQL statements (0 turns it off), sampled statements slower than
+# SLOW_QUERY_THRESHOLD are printed with their parameters, EXPLAIN QUERY PLAN and route,
+# timings of every sampled statement are served by /sql-profile
+SLOW_QUERY_SAMPLE = 0
+SLOW_QUERY_THRESHOLD = 0.1  # s
+# slow statements kept for /sql-profile
+SLOW_QUERY_KEEP = 100
+
+# handlers, create_app adds them to an app
+# cli_group=None: commands are "flask init-db" instead of "flask food init-db"
+bp = Blueprint('food', __name__, cli_group=None)
+
+# connection pool: every thread keeps one connection per database file
+_local = threading.local()
+# connections inherited from a parent process, kept so they are never closed, see _pooled_connection
+_inherited_connections = []
+
+
+class _LRUCache:
+    '''
+    thread-safe dict that forgets the least recently used keys beyond the size given to put
+    '''
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, size):
+        '''
+        returns the number of entries evicted
+        '''
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            evicted = max(len(self.entries) - size, 0)
+            for _ in range(evicted):
+                self.entries.popitem(last=False)
+            return evicted
+
+
+# (database, SID) -> (MV_version, prices, lowercase names, menu entries), see _store_menu
+_menu_cache = _LRUCache()
+
+# (database, SID) -> (MV_prices, prices), see _store_prices
+_price_cache = _LRUCache()
+
+# search_shops cache key -> [expires, response body, refreshing], see _cached_search
+_search_cache = _LRUCache()
+# guards _search_cache_stats and the refreshing flags of _search_cache entries
+_search_cache_lock = threading.Lock()
+_search_cache_stats = collections.Counter(hits=0, misses=0, stale=0, evictions=0)
+
+# database -> _StoreLocations, see _get_store_locations
+_store_locations = {}
+_store_locations_lock = threading.Lock()
+
+
+def _labels(labels):
+    '''
+    Prometheus label set of ((name, value), ...)
+    '''
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class _Metric:
+    '''
+    Prometheus counter (or gauge), its value for every label set
+    '''
+
+    def __init__(self, name, help, kind='counter'):
+        self.name, self.help, self.kind = name, help, kind
+        self.series = {}
+
+    def inc(self, labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self, lines):
+        lines += [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in self.series.items():
+            lines.append(f'{self.name}{_labels(labels)} {value}')
+
+
+class _Histogram(_Metric):
+    '''
+    Prometheus histogram, observations of every label set counted in buckets
+    '''
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help, 'histogram')
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            # observations in each bucket (the last one is +Inf), then their sum
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, lines):
+        lines += [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, series in self.series.items():
+            count = 0
+            for bound, observations in zip(self.buckets + ('+Inf', ), series):
+                count += observations
+                lines.append(f'{self.name}_bucket{_labels(labels + (("le", bound), ))} {count}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {series[-1]}')
+            lines.append(f'{self.name}_count{_labels(labels)} {count}')
+
+
+# recorded by _record_request_metrics, see METRICS
+_metrics_lock = threading.Lock()
+_http_requests = _Metric('http_requests_total', 'requests by route, method and status')
+_http_latency = _Histogram('http_request_duration_seconds', 'time to handle a request', METRICS_LATENCY_BUCKETS)
+_http_bytes = _Metric('http_response_bytes_total', 'size of response bodies, streamed ones are not counted')
+_sql_statements = _Histogram('sql_statements_per_request', 'SQL statements run by a request',
+                             METRICS_STATEMENT_BUCKETS)
+_sql_seconds = _Histogram('sql_seconds_per_request', 'time a request spends in SQLite', METRICS_LATENCY_BUCKETS)
+_sql_rows = _Metric('sql_rows_total', 'rows fetched from SQLite')
+_metrics = [_http_requests, _http_latency, _http_bytes, _sql_statements, _sql_seconds, _sql_rows]
+
+# statement -> (times sampled, total seconds, longest seconds) and the last slow statements, see SLOW_QUERY_SAMPLE
+_sql_profile = {}
+_slow_queries = collections.deque(maxlen=SLOW_QUERY_KEEP)
+_sql_profile_lock = threading.Lock()
+
+
+def _request_route():
+    '''
+    url rule of the current request, rules rather than paths so urls with ids don't make a label set each
+    '''
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _profile_statement(db, sql, parameters, source, elapsed):
+    '''
+    adds a sampled statement to _sql_profile, logs it if it's slow
+    '''
+    statement = ' '.join(sql.split())
+    with _sql_profile_lock:
+        count, total, longest = _sql_profile.get(statement, (0, 0.0, 0.0))
+        _sql_profile[statement] = (count + 1, total + elapsed, max(longest, elapsed))
+    if elapsed < SLOW_QUERY_THRESHOLD:
+        return
+    try:
+        # a plain cursor, so explaining isn't profiled itself
+        plan = [r[3] for r in db.cursor(sqlite3.Cursor).execute('explain query plan ' + sql, parameters)]
+    except sqlite3.Error as e:
+        plan = [f'not explained: {e}']
+    print(f'slow query {elapsed:.3f}s {source}: {statement}')
+    print('    parameters:', parameters)
+    for detail in plan:
+        print('    plan:', detail)
+    with _sql_profile_lock:
+        _slow_queries.append({'statement': statement, 'parameters': repr(parameters), 'plan': plan,
+                              'source': source, 'seconds': elapsed, 'time': time.time()})
+
+
+class _Cursor(sqlite3.Cursor):
+    '''
+    cursor of connections made by _connect when METRICS or SLOW_QUERY_SAMPLE is on,
+    adds statements, the time spent in them and rows fetched to request.sql_metrics,
+    and times a sample of statements for _profile_statement
+    '''
+    sql_metrics = None
+    profile = None  # [sql, parameters, source, seconds] of a sampled statement
+
+    def _start(self, sql, parameters):
+        self._finish()  # statement run before by this cursor
+        # write_transaction jobs of a request run in its context too
+        in_request = has_request_context()
+        self.sql_metrics = getattr(request, 'sql_metrics', None) if in_request else None
+        if SLOW_QUERY_SAMPLE and random.random() < SLOW_QUERY_SAMPLE:
+            source = f'{request.method} {_request_route()}' if in_request else threading.current_thread().name
+            self.profile = [sql, parameters, source, 0.0]
+
+    def _finish(self):
+        # the statement is done when the cursor runs the next one, its rows are all fetched, or it's deleted
+        if self.profile is not None:
+            profile, self.profile = self.profile, None
+            _profile_statement(self.connection, *profile)
+
+    def _record(self, start, statements=0, rows=0):
+        elapsed = time.perf_counter() - start
+        if self.sql_metrics is not None:
+            self.sql_metrics[0] += statements
+            self.sql_metrics[1] += elapsed
+            self.sql_metrics[2] += rows
+        if self.profile is not None:
+            self.profile[3] += elapsed
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(start, statements=1)
+
+    def executemany(self, sql, parameters):
+        # the first parameters are logged and explained
+        self._start(sql, parameters[0] if isinstance(parameters, (list, tuple)) and parameters else ())
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._record(start, statements=1)
+            self._finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record(start, rows=row is not None)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self._record(start, rows=len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record(start, rows=len(rows))
+        self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record(start)
+            self._finish()
+            raise
+        self._record(start, rows=1)
+        return row
+
+    def __del__(self):
+        self._finish()
+
+
+class _Connection(sqlite3.Connection):
+    '''
+    hands out _Cursor, also to the execute shortcuts
+    '''
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+def _connect(database):
+    '''
+    opens and configures a database connection
+    '''
+    db = sqlite3.connect(database, cached_statements=SQLITE_STATEMENT_CACHE,
+                         factory=_Connection if METRICS or SLOW_QUERY_SAMPLE else sqlite3.Connection)
+    db.row_factory = sqlite3.Row
+    db.create_function('_GIO_DIS', 4, _distance_between_locations, deterministic=True)
+    db.create_function('_GIO_DOT', 5, _unit_dot, deterministic=True)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        db.cursor().execute(f"PRAGMA {pragma}={value}")
+    return db
+
+
+def _pooled_connection(database):
+    '''
+    returns the connection of the current thread, connecting on first use
+    '''
+    if getattr(_local, 'pid', None) != os.getpid():
+        # first use in this thread, or process forked: never reuse the parent's connections,
+        # nor close them, closing a connection opened before fork can release the parent's locks
+        _inherited_connections.extend(getattr(_local, 'connections', {}).values())
+        _local.pid = os.getpid()
+        _local.connections = {}
+    db = _local.connections.get(database)
+    if db is None:
+        db = _local.connections[database] = _connect(database)
+    return db
+
+
+def _close_pooled_connection(database):
+    '''
+    closes the connection of the current thread, the next _pooled_connection opens another
+    '''
+    if getattr(_local, 'pid', None) == os.getpid():
+        db = _local.connections.pop(database, None)
+        if db is not None:
+            db.close()
 
 
 def get_db():
@@ -29,33 +468,469 @@ def get_db():
     '''
     db = getattr(g, '_database', None)
     if db is None:
-        db = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-        db.create_function('_GIO_DIS', 4, _distance_between_locations)
-        g._database = db
-    db.cursor().execute("PRAGMA foreign_keys=ON")
+        db = g._database = _pooled_connection(current_app.config['DATABASE'])
     return db
 
 
-@app.teardown_appcontext
+class _Writer:
+    '''
+    single writer thread of a process
+    runs write jobs on its own connection and commits all queued jobs at once,
+    every job runs in a savepoint so a failing job doesn't undo the others
+    '''
+
+    def __init__(self, database):
+        self.database = database
+        self.pid = os.getpid()
+        self.jobs = queue.Queue()
+        threading.Thread(target=self._run, name='db-writer', daemon=True).start()
+
+    def submit(self, function, *args):
+        future = Future()
+        self.jobs.put((future, function, args))
+        return future
+
+    def _run(self):
+        db = _connect(self.database)
+        db.isolation_level = None  # transactions are managed below
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(db, batch)
+
+    def _run_batch(self, db, batch):
+        results = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for future, function, args in batch:
+                db.execute("SAVEPOINT job")
+                try:
+                    result = function(db, *args)
+                except Exception as e:
+                    db.execute("ROLLBACK TO job")
+                    results.append((future, e, False))
+                else:
+                    results.append((future, result, True))
+                db.execute("RELEASE job")
+            db.execute("COMMIT")
+        except sqlite3.Error as e:
+            # the batch could not be committed, fail every job in it
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            results = [(future, e, False) for future, _, _ in batch]
+
+        for future, result, ok in results:
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+
+_writers = {}
+_writer_lock = threading.Lock()
+
+
+def _get_writer(database):
+    '''
+    returns the writer thread of database in this process, starting it on first use
+    '''
+    with _writer_lock:
+        writer = _writers.get(database)
+        if writer is None or writer.pid != os.getpid():
+            # first use, or process forked: the parent's thread doesn't exist here
+            writer = _writers[database] = _Writer(database)
+        return writer
+
+
+class AbortTransaction(Exception):
+    '''
+    raised by write_transaction jobs to roll back, the message is shown to the user
+    '''
+
+
+def write_transaction(function, *args):
+    '''
+    runs function(db, *args) in one write transaction and returns its result
+    function must not commit, an exception raised by it rolls its writes back and is re-raised
+    '''
+    if SERIALIZED_WRITES:
+        if has_request_context():
+            # lets jobs use url_for on the writer thread
+            function = copy_current_request_context(function)
+        database = current_app.config['DATABASE'] if has_app_context() else DATABASE
+        return _get_writer(database).submit(function, *args).result()
+
+    db = get_db() if has_app_context() else _pooled_connection(DATABASE)
+    db.cursor().execute("BEGIN IMMEDIATE")
+    try:
+        result = function(db, *args)
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+    return result
+
+
 def close_connection(exception):
     '''
-    close database after session ends
+    return database to the pool after session ends
     '''
     db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        # handler failed before commit
+        db.rollback()
+
+
+def _credit_shop_owner(db, UID, amount):
+    '''
+    adds amount (negative for refunds) to the balance of shop owner UID in a write_transaction job
+    returns False, changing nothing, if the balance would become negative
+    '''
+    if not DEFERRED_SETTLEMENT:
+        return db.cursor().execute('''
+            update Users
+            set U_balance = U_balance + :amount
+            where UID = :UID and U_balance + :amount >= 0
+        ''', {'UID': UID, 'amount': amount}).rowcount == 1
+
+    # pending credits count as balance already
+    return db.cursor().execute('''
+        insert into Pending_Credits (UID, PC_amount)
+        select :UID, :amount
+        where :amount >= 0 or (
+            select U_balance + (select coalesce(sum(PC_amount), 0) from Pending_Credits where UID = :UID)
+            from Users
+            where UID = :UID) + :amount >= 0
+    ''', {'UID': UID, 'amount': amount}).rowcount == 1
+
+
+def settle_balances(db, UID=None):
+    '''
+    write_transaction job adding Pending_Credits (of UID, or everyone) to U_balance
+    '''
+    users = '' if UID is None else 'and UID = :UID'
+    db.cursor().execute(f'''
+        update Users
+        set U_balance = U_balance + (select sum(PC_amount) from Pending_Credits where UID = Users.UID)
+        where UID in (select UID from Pending_Credits) {users}
+    ''', {'UID': UID})
+    db.cursor().execute(f"delete from Pending_Credits where 1 {users}", {'UID': UID})
+
+
+_settlement = {}
+_settlement_lock = threading.Lock()
+
+
+@bp.before_app_request
+def _start_settlement():
+    '''
+    starts the thread running settle_balances every SETTLEMENT_INTERVAL seconds,
+    once per process and database, when the process serves its first request
+    '''
+    if not DEFERRED_SETTLEMENT:
+        return
+    database = current_app.config['DATABASE']
+    if _settlement.get(database) == os.getpid():
+        return
+    with _settlement_lock:
+        if _settlement.get(database) == os.getpid():
+            return
+        _settlement[database] = os.getpid()
+    threading.Thread(target=_settle_periodically, args=(current_app._get_current_object(), ),
+                     name='db-settlement', daemon=True).start()
+
+
+def _settle_periodically(app):
+    while True:
+        time.sleep(SETTLEMENT_INTERVAL)
+        try:
+            with app.app_context():
+                write_transaction(settle_balances)
+        except Exception as e:
+            print("settlement failed:", type(e), str(e))
+
+
+def _migrate_baseline(db):
+    '''
+    schema.sql, also adopts databases made before migrations were tracked
+    '''
+    fts_tables = ['Stores_fts', 'Products_fts']
+    existing = [r['name'] for r in db.cursor().execute(
+        "select name from sqlite_master where name in (?, ?)", fts_tables)]
+    with current_app.open_resource(SCHEMA, mode='r') as f:
+        db.cursor().executescript(f.read())  # executescript can run multiple commands
+
+    # index rows inserted before the full-text tables existed
+    for table in fts_tables:
+        if table not in existing:
+            db.cursor().execute(f"insert into {table}({table}) values ('rebuild')")
+
+    # databases created before these Products columns existed
+    _add_column(db, 'Products', 'P_image_hash', 'VARCHAR(64)')
+    _add_column(db, 'Products', 'P_thumb_hash', 'VARCHAR(64)')
+    rst = db.cursor().execute(
+        "select PID, P_image from Products where P_image_hash is NULL").fetchall()
+    for PID, P_image in rst:
+        db.cursor().execute("update Products set P_image_hash = ? where PID = ?",
+                            (_image_hash(base64.b64decode(P_image)), PID))
+
+
+def _migrate_secondary_indexes(db):
+    '''
+    indexes for the columns handlers filter on
+    '''
+    db.cursor().executescript('''
+        create index if not exists Products_P_store on Products(P_store, P_price);
+        create index if not exists Products_P_owner on Products(P_owner);
+        create index if not exists Stores_S_owner on Stores(S_owner);
+        create index if not exists Orders_SID on Orders(SID);
+        create index if not exists Process_Order_OID on Process_Order(OID);
+        create index if not exists Transaction_Record_T_Subject on Transaction_Record(T_Subject);
+        create index if not exists Transaction_Record_T_Object on Transaction_Record(T_Object);
+    ''')
+
+
+def _add_column(db, table, column, definition):
+    '''
+    alter table add column, unless table already has column
+    '''
+    columns = [r['name'] for r in db.cursor().execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        db.cursor().execute(f"alter table {table} add column {column} {definition}")
 
 
-def init_db():
+def _migrate_transaction_subject_index(db):
+    '''
+    (T_Subject, TID) index for paging through transaction records
+    '''
+    # same keys as the T_Subject index (TID is the rowid), but the keyset order is spelled out
+    db.cursor().executescript('''
+        create index if not exists Transaction_Record_T_Subject_TID on Transaction_Record(T_Subject, TID);
+        drop index if exists Transaction_Record_T_Subject;
+    ''')
+
+
+def _migrate_order_status_index(db):
+    '''
+    (SID, O_status) index for the order queue of a store
+    '''
+    db.cursor().executescript('''
+        create index if not exists Orders_SID_O_status on Orders(SID, O_status);
+    ''')
+
+
+def _migrate_order_items(db):
+    '''
+    Order_Items instead of product snapshots in Orders.O_details
+    '''
+    db.cursor().executescript('''
+        create table if not exists Order_Items(
+            OID INT NOT NULL,
+            PID INT NOT NULL,
+            -- no foreign key, products may be deleted after being ordered
+            OI_name VARCHAR(256) NOT NULL,
+            OI_price INT NOT NULL,
+            -- unit price when ordered
+            OI_quantity INT NOT NULL,
+            PRIMARY key (OID, PID),
+            FOREIGN key (OID) REFERENCES Orders(OID)
+        );
+        create index if not exists Order_Items_PID on Order_Items(PID);
+        -- images shown by order details, kept when their product is deleted
+        create table if not exists Snapshot_Images(
+            SI_hash VARCHAR(64) PRIMARY KEY,
+            SI_image BLOB NOT NULL,
+            -- raw image
+            SI_imagetype VARCHAR(16) NOT NULL
+        );
+    ''')
+
+    # rewrite snapshots of orders made before, a batch at a time
+    # orders already rewritten (by an interrupted run) have no Products, an empty Products is a valid order
+    rewritten, last = 0, -1
+    while True:
+        rst = db.cursor().execute('''
+            select OID, O_details
+            from Orders
+            where OID > ?
+            order by OID
+            limit 500
+        ''', (last, )).fetchall()
+        if not rst:
+            break
+        last = rst[-1][0]
+        for OID, O_details in rst:
+            details = _parse_order_details(O_details)
+            if 'Products' not in details:
+                continue
+            rewritten += 1
+            images = []
+            for product in details['Products']:
+                if 'P_image' in product:
+                    # image copied into the snapshot, base64 of the base64 stored in Products
+                    image = base64.b64decode(base64.b64decode(product['P_image']))
+                    digest = _image_hash(image)
+                    db.cursor().execute('''
+                        insert or ignore into Snapshot_Images (SI_hash, SI_image, SI_imagetype)
+                        values (?, ?, ?)
+                    ''', (digest, image, product['P_imagetype']))
+                else:
+                    digest = product['P_image_url'].rsplit('/', 1)[1]
+                images.append([product['PID'], digest, product['P_imagetype']])
+                db.cursor().execute('''
+                    insert into Order_Items (OID, PID, OI_name, OI_price, OI_quantity)
+                    values (?, ?, ?, ?, ?)
+                    on conflict (OID, PID) do update set OI_quantity = OI_quantity + excluded.OI_quantity
+                ''', (OID, product['PID'], product['P_name'], product['P_price'], product['Order_quantity']))
+            db.cursor().execute("update Orders set O_details = ? where OID = ?", (
+                _dump_order_details(details['Subtotal'], details['Delivery_fee'], images), OID))
+        db.commit()
+
+    if rewritten:
+        # give the space of the old snapshots back
+        db.cursor().execute("VACUUM")
+        db.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def _migrate_pending_credits(db):
+    '''
+    ledger of shop owner credits not added to U_balance yet, see DEFERRED_SETTLEMENT
+    '''
+    db.cursor().executescript('''
+        create table if not exists Pending_Credits(
+            PCID INTEGER PRIMARY KEY AUTOINCREMENT,
+            UID INT NOT NULL,
+            PC_amount INT NOT NULL,
+            -- negative for refunds
+            FOREIGN key (UID) REFERENCES Users(UID)
+        );
+        create index if not exists Pending_Credits_UID on Pending_Credits(UID, PC_amount);
+    ''')
+
+
+def _migrate_menu_versions(db):
+    '''
+    Menu_Versions.MV_version of a store changes whenever one of its products is added, changed or deleted,
+    cached menus of an older version are stale, see _store_menu
+    bumped by triggers so every write path, in any worker process, invalidates the cache
+    '''
+    db.cursor().executescript('''
+        create table if not exists Menu_Versions(
+            SID INTEGER PRIMARY KEY,
+            MV_version INT NOT NULL,
+            FOREIGN key (SID) REFERENCES Stores(SID)
+        );
+        create trigger if not exists Products_menu_insert after insert on Products begin
+            insert into Menu_Versions (SID, MV_version) values (new.P_store, 1)
+            on conflict (SID) do update set MV_version = MV_version + 1;
+        end;
+        create trigger if not exists Products_menu_update
+        after update of P_name, P_price, P_quantity, P_imagetype, P_image_hash, P_thumb_hash, P_owner, P_store
+        on Products begin
+            insert into Menu_Versions (SID, MV_version) values (new.P_store, 1)
+            on conflict (SID) do update set MV_version = MV_version + 1;
+            insert into Menu_Versions (SID, MV_version) select old.P_store, 1 where old.P_store != new.P_store
+            on conflict (SID) do update set MV_version = MV_version + 1;
+        end;
+        create trigger if not exists Products_menu_delete after delete on Products begin
+            insert into Menu_Versions (SID, MV_version) values (old.P_store, 1)
+            on conflict (SID) do update set MV_version = MV_version + 1;
+        end;
+    ''')
+
+
+def _migrate_unit_vectors(db):
+    '''
+    unit vectors of store locations, see _unit_vector and SQL_DISTANCE, kept by shop_register
+    searches get the user location from the request, so users have none
+    '''
+    for axis in 'xyz':
+        _add_column(db, 'Stores', f'S_{axis}', 'REAL')
+    rst = db.cursor().execute("select SID, S_latitude, S_longitude from Stores where S_x is NULL").fetchall()
+    db.cursor().executemany('''
+        update Stores set S_x = ?, S_y = ?, S_z = ? where SID = ?
+    ''', [(*_unit_vector(lat, lon), SID) for SID, lat, lon in rst])
+
+
+def _migrate_price_versions(db):
+    '''
+    Menu_Versions.MV_prices of a store changes whenever one of its products is added, deleted or gets
+    another price, cached price arrays of an older version are stale, see _store_prices
+    unlike MV_version it doesn't change when orders update P_quantity
+    '''
+    _add_column(db, 'Menu_Versions', 'MV_prices', 'INT NOT NULL DEFAULT 0')
+    db.cursor().executescript('''
+        create trigger if not exists Products_prices_insert after insert on Products begin
+            insert into Menu_Versions (SID, MV_version, MV_prices) values (new.P_store, 1, 1)
+            on conflict (SID) do update set MV_prices = MV_prices + 1;
+        end;
+        create trigger if not exists Products_prices_update after update of P_price, P_store on Products begin
+            insert into Menu_Versions (SID, MV_version, MV_prices) values (new.P_store, 1, 1)
+            on conflict (SID) do update set MV_prices = MV_prices + 1;
+            insert into Menu_Versions (SID, MV_version, MV_prices) select old.P_store, 1, 1
+            where old.P_store != new.P_store
+            on conflict (SID) do update set MV_prices = MV_prices + 1;
+        end;
+        create trigger if not exists Products_prices_delete after delete on Products begin
+            insert into Menu_Versions (SID, MV_version, MV_prices) values (old.P_store, 1, 1)
+            on conflict (SID) do update set MV_prices = MV_prices + 1;
+        end;
+    ''')
+
+
+# applied in order by init_db, a database at version n (PRAGMA user_version) has run the first n
+# append new migrations to the end, never edit or reorder released ones
+# migrations should be idempotent: a failed one is run again on next start
+MIGRATIONS = [
+    _migrate_baseline,
+    _migrate_secondary_indexes,
+    _migrate_transaction_subject_index,
+    _migrate_order_status_index,
+    _migrate_order_items,
+    _migrate_pending_credits,
+    _migrate_menu_versions,
+    _migrate_unit_vectors,
+    _migrate_price_versions,
+]
+
+
+def init_db(app):
     '''
-    initialize database
+    initialize database of app, run migrations it hasn't run yet
+    run once before starting workers (flask init-db), not in every worker
+    fork-safe (gunicorn.conf.py runs it in the master): starts no threads and closes its connection
     '''
     with app.app_context():
         db = get_db()
-        with app.open_resource(SCHEMA, mode='r') as f:
-            db.cursor().executescript(f.read())  # executescript can run multiple commands
-        db.commit()
+        version = db.cursor().execute("PRAGMA user_version").fetchone()[0]
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            print(f'migrating {app.config["DATABASE"]} to version {version}: {migration.__name__}')
+            migration(db)
+            db.cursor().execute(f"PRAGMA user_version = {version}")
+            db.commit()
+
+        # products uploaded before variants were made
+        if Image is not None:
+            PIDs = db.cursor().execute("select PID from Products where P_thumb_hash is NULL").fetchall()
+            for i, (PID, ) in enumerate(PIDs):
+                rst = db.cursor().execute("select P_image from Products where PID = ?", (PID, )).fetchone()
+                _store_image_variants(db, PID, _image_variants(PID, base64.b64decode(rst[0])))
+                db.commit()
+                if (i + 1) % 1000 == 0:
+                    print(f'image variants of {i + 1} / {len(PIDs)} products made')
+    _close_pooled_connection(app.config['DATABASE'])
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    '''
+    create or migrate the database
+    '''
+    init_db(current_app)
 
 
 def _distance_between_locations(lat1, lon1, lat2, lon2):
@@ -63,8 +938,7 @@ def _distance_between_locations(lat1, lon1, lat2, lon2):
     calculates distance between two locations
     '''
 
-    # approximate radius of earth in km
-    R = 6373.0
+    R = EARTH_RADIUS
 
     lat1 = math.radians(float(lat1))
     lon1 = math.radians(float(lon1))
@@ -83,6 +957,233 @@ def _distance_between_locations(lat1, lon1, lat2, lon2):
     return str(distance)
 
 
+def _unit_vector(lat, lon):
+    '''
+    (x, y, z) of a location on the unit sphere,
+    the dot product of two is the cosine of the angle between the locations
+    '''
+    lat, lon = math.radians(float(lat)), math.radians(float(lon))
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+def _unit_dot(lat, lon, x, y, z):
+    '''
+    dot product of the unit vector of (lat, lon) and (x, y, z), for stores saved without S_x, S_y, S_z
+    '''
+    a, b, c = _unit_vector(lat, lon)
+    return a * x + b * y + c * z
+
+
+def _bounding_box(lat, lon, radius):
+    '''
+    returns (min_lat, max_lat, min_lon, max_lon) of a box containing
+    every location within radius (km) of (lat, lon)
+    '''
+    lat, lon = float(lat), float(lon)
+    # pad 1 meter so floating point errors never drop a boundary store
+    angle = (radius + 0.001) / EARTH_RADIUS
+
+    d_lat = math.degrees(angle)
+    min_lat, max_lat = lat - d_lat, lat + d_lat
+    if min_lat <= -90 or max_lat >= 90:
+        # box covers a pole, every longitude is inside
+        return max(min_lat, -90), min(max_lat, 90), -180, 180
+
+    d_lon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+    min_lon, max_lon = lon - d_lon, lon + d_lon
+    if min_lon < -180 or max_lon > 180:
+        # box crosses the antimeridian
+        return min_lat, max_lat, -180, 180
+    return min_lat, max_lat, min_lon, max_lon
+
+
+class _StoreLocations:
+    '''
+    SIDs and locations of every store in contiguous NumPy arrays, sorted by SID
+    refresh loads stores registered since the last refresh, store locations are never edited
+    '''
+
+    def __init__(self):
+        # (SIDs, [[S_latitude, S_longitude]], the same in radians, cos(S_latitude)), replaced as a whole by refresh
+        self.table = (numpy.empty(0, dtype=numpy.int64), numpy.empty((0, 2)), numpy.empty((0, 2)), numpy.empty(0))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.table[0])
+
+    def refresh(self, db):
+        SIDs = self.table[0]
+        last = int(SIDs[-1]) if len(SIDs) else 0
+        rst = db.cursor().execute(
+            "select SID, S_latitude, S_longitude from Stores where SID > ? order by SID", (last, )).fetchall()
+        if not rst:
+            return
+        rows = numpy.array(rst, dtype=numpy.float64)
+        with self.lock:
+            SIDs, degrees, radians, cos_lat = self.table
+            if len(SIDs):
+                # another thread may have loaded some of them
+                rows = rows[rows[:, 0] > SIDs[-1]]
+            new = numpy.ascontiguousarray(rows[:, 1:])
+            self.table = (numpy.concatenate([SIDs, rows[:, 0].astype(numpy.int64)]),
+                          numpy.concatenate([degrees, new]), numpy.concatenate([radians, numpy.radians(new)]),
+                          numpy.concatenate([cos_lat, numpy.cos(numpy.radians(new[:, 0]))]))
+
+    def distances(self, lat, lon):
+        '''
+        returns (SIDs, km from (lat, lon) to each store), the same formula as _distance_between_locations
+        distances within 1 mm of a DISTANCE_BOUNDARY are computed by _distance_between_locations,
+        so stores are put in the same bucket as _GIO_DIS would
+        '''
+        SIDs, degrees, radians, cos_lat = self.table
+        lat, lon = float(lat), float(lon)
+        lat_r, lon_r = math.radians(lat), math.radians(lon)
+        dlat = lat_r - radians[:, 0]
+        dlon = lon_r - radians[:, 1]
+        a = numpy.sin(dlat / 2)**2 + cos_lat * math.cos(lat_r) * numpy.sin(dlon / 2)**2
+        distances = EARTH_RADIUS * (2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a)))
+        for boundary in DISTANCE_BOUNDARY.values():
+            for i in numpy.flatnonzero(numpy.abs(distances - boundary) < 1e-6):
+                distances[i] = float(_distance_between_locations(*degrees[i], lat, lon))
+        return SIDs, distances
+
+    def nearest(self, lat, lon, k):
+        '''
+        returns (SIDs, distances) of the k stores nearest to (lat, lon), nearest first
+        '''
+        SIDs, distances = self.distances(lat, lon)
+        if k < len(SIDs):
+            nearest = numpy.argpartition(distances, k)[:k]
+            SIDs, distances = SIDs[nearest], distances[nearest]
+        order = numpy.argsort(distances, kind='stable')
+        return SIDs[order], distances[order]
+
+    def buckets(self, lat, lon):
+        '''
+        returns (SIDs, distances, {bucket: boolean mask of stores in it}) like the distance of search_shops,
+        NaN distances are far
+        '''
+        SIDs, distances = self.distances(lat, lon)
+        near, far = distances < DISTANCE_BOUNDARY['medium'], ~(distances < DISTANCE_BOUNDARY['far'])
+        return SIDs, distances, {'near': near, 'medium': ~near & ~far, 'far': far}
+
+
+def _get_store_locations(db):
+    '''
+    returns the _StoreLocations of the database of the app, refreshed
+    '''
+    database = current_app.config['DATABASE']
+    with _store_locations_lock:
+        locations = _store_locations.get(database)
+        if locations is None:
+            locations = _store_locations[database] = _StoreLocations()
+    locations.refresh(db)
+    return locations
+
+
+def _image_hash(image):
+    '''
+    content hash of a raw image, used as its ETag and in its url
+    '''
+    return hashlib.sha256(image).hexdigest()
+
+
+def _resize_image(image, variant):
+    '''
+    returns (bytes, imagetype) of one IMAGE_VARIANTS of a raw image
+    '''
+    size = IMAGE_VARIANTS[variant]
+    with Image.open(io.BytesIO(image)) as img:
+        img = ImageOps.exif_transpose(img)
+        img = ImageOps.fit(img, size)
+
+        output = io.BytesIO()
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # keep transparency
+            img.save(output, 'PNG', optimize=True)
+            return output.getvalue(), 'png'
+        img.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+        return output.getvalue(), 'jpeg'
+
+
+_executors = {}  # name -> (pid, executor)
+_executors_lock = threading.Lock()
+
+
+def _background_executor(name, max_workers):
+    '''
+    returns the ThreadPoolExecutor called name of this process
+    '''
+    with _executors_lock:
+        pid, executor = _executors.get(name, (None, None))
+        if pid != os.getpid():
+            # threads of a parent process don't exist after fork
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            _executors[name] = (os.getpid(), executor)
+        return executor
+
+
+def _submit_image_job(PID, image=None):
+    '''
+    runs _make_image_variants in the background threads of this process (so uploads don't wait for it)
+    '''
+    app = current_app._get_current_object()
+
+    def job():
+        with app.app_context():
+            _make_image_variants(PID, image)
+    _background_executor('image', 2).submit(job)
+
+
+def _image_variants(PID, image):
+    '''
+    [(variant, bytes, imagetype)] of every IMAGE_VARIANTS of a raw product image, None if Pillow can't read it
+    '''
+    try:
+        return [(variant, *_resize_image(image, variant)) for variant in IMAGE_VARIANTS]
+    except Exception as e:
+        print("image variants failed:", PID, type(e), str(e))
+        return None
+
+
+def _store_image_variants(db, PID, variants):
+    '''
+    stores the _image_variants of a product and points Products.P_thumb_hash to the thumbnail
+    '''
+    if variants is None:
+        # not an image Pillow can read, listings keep showing the uploaded file and it isn't tried again
+        db.execute("update Products set P_thumb_hash = P_image_hash where PID = ?", (PID, ))
+        return
+    for variant, data, imagetype in variants:
+        db.execute('''
+            insert or replace into Product_Images (PID, PI_variant, PI_image, PI_imagetype, PI_hash)
+            values (?, ?, ?, ?, ?)
+        ''', (PID, variant, data, imagetype, _image_hash(data)))
+    db.execute('''
+        update Products
+        set P_thumb_hash = (select PI_hash from Product_Images where PID = ? and PI_variant = 'thumb')
+        where PID = ?
+    ''', (PID, PID))
+
+
+def _make_image_variants(PID, image=None):
+    '''
+    runs in the threads of _submit_image_job, makes and stores the variants of a product image
+    '''
+    if image is None:
+        db = get_db()
+        rst = db.execute("select P_image from Products where PID = ?", (PID, )).fetchone()
+        if rst is None:
+            return
+        image = base64.b64decode(rst[0])
+    variants = _image_variants(PID, image)
+    try:
+        write_transaction(_store_image_variants, PID, variants)
+    except sqlite3.Error as e:
+        # e.g. product deleted before its variants were ready
+        print("image variants failed:", PID, type(e), str(e))
+
+
 def login_required(function):
     '''
     function wrapper that checks login status
@@ -93,22 +1194,22 @@ def login_required(function):
         if user_info is None:
             # not logged in
             flash("Please login first")
-            return redirect(url_for("index"))
+            return redirect(url_for(".index"))
         else:
             # logged in
             return function(*args, **kwargs)
     return wrap
 
 
-@app.route("/")
+@bp.route("/")
 def home():
     '''
     redirect user to index.html ie sign-in page
     '''
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
 
-@app.route("/index.html")
+@bp.route("/index.html")
 def index():
     '''
     renders login page
@@ -116,7 +1217,58 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/order_made", methods=['POST'])
+def _dump_order_details(Subtotal, Delivery_fee, images):
+    '''
+    O_details of an order, its products are in Order_Items
+    images: [PID, image hash, image type] of every product
+    '''
+    details = json.dumps({'Subtotal': Subtotal, 'Delivery_fee': Delivery_fee, 'Images': images},
+                         separators=(',', ':'))
+    if ORDER_DETAILS_ZLIB:
+        compressed = zlib.compress(details.encode())
+        if len(compressed) < len(details):
+            return compressed
+    return details
+
+
+def _parse_order_details(O_details):
+    '''
+    O_details as a dict, compressed or not
+    '''
+    if isinstance(O_details, bytes) and not O_details.startswith(b'{'):
+        O_details = zlib.decompress(O_details)
+    return json.loads(O_details)
+
+
+def _load_order_details(db, OID):
+    '''
+    products, subtotal and delivery fee of an order as sent to nav.html, None if there is no such order
+    '''
+    rst = db.cursor().execute('''
+        select O_details, SID, S_owner
+        from Orders natural join Stores
+        where OID = ?
+        ''', (OID, )).fetchone()
+    if rst is None:
+        return None
+    details = _parse_order_details(rst['O_details'])
+    images = {PID: (digest, imagetype) for PID, digest, imagetype in details['Images']}
+    items = db.cursor().execute('''
+        select PID, OI_name, OI_price, OI_quantity
+        from Order_Items
+        where OID = ?
+        order by rowid
+        ''', (OID, )).fetchall()
+    Products = []
+    for PID, name, price, quantity in items:
+        digest, imagetype = images[PID]
+        Products.append({'PID': PID, 'P_name': name, 'P_price': price, 'Order_quantity': quantity,
+                         'P_imagetype': imagetype, 'P_owner': rst['S_owner'], 'P_store': rst['SID'],
+                         'P_image_url': url_for('.product_image', PID=PID, digest=digest)})
+    return {'Products': Products, 'Subtotal': details['Subtotal'], 'Delivery_fee': details['Delivery_fee']}
+
+
+@bp.route("/order_made", methods=['POST'])
 @login_required
 def order_made():
     '''
@@ -137,11 +1289,6 @@ def order_made():
     # get user data
     UID = session['user_info']['UID']
     db = get_db()
-    user_info = db.cursor().execute('''
-        select *
-        from Users
-        where UID = ?
-        ''', (UID,)).fetchone()
 
     # get shop owner UID & shop SID
     shop_owner_UID = json_data['S_owner']
@@ -152,125 +1299,114 @@ def order_made():
     ''', (shop_owner_UID,)).fetchone()['SID']
     print("shop_owner_UID:", shop_owner_UID)
 
-    # check all ordered products one by one
-    Subtotal = 0
-    Products = []
-    non_sufficient_product_name = []
+    # ordered quantity of each product, repeated PIDs are merged
+    Quantities = {}
     for PID, Quantity in zip(json_data['PIDs'], json_data['Quantities']):
-        db = get_db()
-        rst = db.cursor().execute('''
-            select *
-            from Products
-            where PID = ?
-            ''', (PID,)).fetchone()
-        # check if product exists
-        if rst is None:
-            return jsonify({
-                'message': 'Failed to create order: one or more products does not exist'
-            }), 200
-        # product exists, check if product is sufficient
-        elif Quantity > rst['P_quantity']:
-            non_sufficient_product_name.append(rst['P_name'])
-        # calculate subtotal
-        Subtotal += rst['P_price'] * Quantity
-
-        rst = dict(rst)
-        rst['P_image'] = base64.b64encode(rst['P_image']).decode()
-        rst['Order_quantity'] = Quantity
-        del rst['P_quantity']  # useless
-        Products.append(rst)
-
-    # check if product quantity sufficient
-    if len(non_sufficient_product_name) > 0:
+        Quantities[int(PID)] = Quantities.get(int(PID), 0) + int(Quantity)
+    if not Quantities or min(Quantities.values()) <= 0:
         return jsonify({
-            'message': "Failed to create order: insufficient quantity of {}".format(
-                non_sufficient_product_name)
+            'message': 'Failed to create order: order content must be valid'
         }), 200
-    # check if wallet ballence sufficient
+
     # calculate fee
     lat1, lon1 = db.cursor().execute("select U_latitude, U_longitude from Users where UID = ?",
                                      (UID, )).fetchone()
     lat2, lon2 = db.cursor().execute("select S_latitude, S_longitude from Stores where S_owner = ?",
                                      (shop_owner_UID, )).fetchone()
     distance = float(_distance_between_locations(lat1, lon1, lat2, lon2))
-
     Delivery_fee = 0 if json_data['Type'] == '0' else max(
         int(round(distance * 10)), 10)
-    Total = Subtotal + Delivery_fee
-    if Total > user_info['U_balance']:
-        return jsonify({
-            'message': "Failed to create order: insufficient balance"
-        }), 200
 
-    # create successful, update database
-    try:
+    # stock and balance are checked by the updates themselves, so concurrent orders can't oversell
+    def place_order(db):
+        # get all ordered products at once
+        rst = db.cursor().execute(f'''
+            select {MENU_COLUMNS}
+            from Products
+            where PID in (select value from json_each(?))
+            ''', (json.dumps(list(Quantities)), )).fetchall()
+        # check if all products exist
+        if len(rst) != len(Quantities):
+            raise AbortTransaction('Failed to create order: one or more products does not exist')
+        rst = {r['PID']: r for r in rst}
+
+        # calculate subtotal
+        Subtotal = 0
+        for PID, Quantity in Quantities.items():
+            Subtotal += rst[PID]['P_price'] * Quantity
+
+        # update Products, only if product quantity sufficient
+        if db.cursor().executemany('''
+            update Products
+            set P_quantity = P_quantity - ?
+            where PID = ? and P_quantity >= ?
+        ''', [(Quantity, PID, Quantity) for PID, Quantity in Quantities.items()]).rowcount != len(Quantities):
+            non_sufficient_product_name = [rst[PID]['P_name'] for PID, Quantity in Quantities.items()
+                                           if Quantity > rst[PID]['P_quantity']]
+            raise AbortTransaction("Failed to create order: insufficient quantity of {}".format(
+                non_sufficient_product_name))
+
         # update Users
-        # customer
-        db = get_db()
-        db.cursor().execute('''
+        # customer, only if wallet ballence sufficient
+        # (a shop owner can spend credits not settled yet)
+        Total = Subtotal + Delivery_fee
+        settle_balances(db, UID)
+        if db.cursor().execute('''
             update Users
             set U_balance = U_balance - ?
-            where UID = ?
-        ''', (Total, user_info['UID']))
+            where UID = ? and U_balance >= ?
+        ''', (Total, UID, Total)).rowcount == 0:
+            raise AbortTransaction("Failed to create order: insufficient balance")
         # shop owner
-        db.cursor().execute('''
-            update Users
-            set U_balance = U_balance + ?
-            where UID = ?
-        ''', (Total, shop_owner_UID))
+        _credit_shop_owner(db, shop_owner_UID, Total)
 
         # update Orders
-        details_str = json.dumps({
-            'Products': Products,
-            'Subtotal': Subtotal,
-            'Delivery_fee': Delivery_fee,
-        })
-        rst = db.cursor().execute('''
+        # images by hash, the one shown in listings (see _menu_entry)
+        images = [[PID, rst[PID]['P_thumb_hash'] or rst[PID]['P_image_hash'], rst[PID]['P_imagetype']]
+                  for PID in Quantities]
+        OID = db.cursor().execute('''
             insert into Orders (O_status, O_end_time, O_distance, O_amount, O_type, O_details, SID)
             values (?, ?, ?, ?, ?, ?, ?)
-        ''', (0, None, distance, Total, json_data['Type'], details_str, SID))
+        ''', (0, None, distance, Total, json_data['Type'], _dump_order_details(Subtotal, Delivery_fee, images),
+              SID)).lastrowid
+
+        # update Order_Items
+        db.cursor().executemany('''
+            insert into Order_Items (OID, PID, OI_name, OI_price, OI_quantity)
+            values (?, ?, ?, ?, ?)
+        ''', [(OID, PID, rst[PID]['P_name'], rst[PID]['P_price'], Quantity) for PID, Quantity in Quantities.items()])
 
         # update Process_Order
-        OID = rst.lastrowid
         db.cursor().execute('''
             insert into Process_Order (UID, OID, PO_type)
             values (?, ?, ?)
         ''', (UID, OID, 0))
 
         # update Transaction_Record
-        # user -> shop
-        db.cursor().execute('''
+        # user -> shop, shop <- user
+        db.cursor().executemany('''
             insert into Transaction_Record (T_action, T_amount, T_Subject, T_Object)
             values (?, ?, ?, ?)
-        ''', (0, -Total, UID, shop_owner_UID))
-        # shop <- user
-        db.cursor().execute('''
-            insert into Transaction_Record (T_action, T_amount, T_Subject, T_Object)
-            values (?, ?, ?, ?)
-        ''', (1, Total, shop_owner_UID, UID))
+        ''', [(0, -Total, UID, shop_owner_UID), (1, Total, shop_owner_UID, UID)])
 
-        # update Products
-        for PID, Quantity in zip(json_data['PIDs'], json_data['Quantities']):
-            db.cursor().execute('''
-                update Products
-                set P_quantity = P_quantity - ?
-                where PID = ?
-            ''', (Quantity, PID))
+    try:
+        write_transaction(place_order)
+    except AbortTransaction as e:
+        return jsonify({
+            'message': str(e)
+        }), 200
     except Exception as e:
         print(type(e), str(e))
-        db.rollback()
         return jsonify({
             'message': 'Failed to create order: please try again'
         }), 200
 
-    db.commit()
-
     return jsonify({
         'message': 'Order made successfully'
     }), 200
 
 
-@app.route("/order_preview", methods=['POST'])
+@bp.route("/order_preview", methods=['POST'])
 @login_required
 def order_preview():
     '''
@@ -284,52 +1420,42 @@ def order_preview():
         for PID, Q in zip(request.form.getlist('PIDs'), request.form.getlist('Quantities')):
             Q = 0 if Q == '' else int(Q)
             if Q > 0:
-                PIDs.append(PID)
+                PIDs.append(int(PID))
                 Quantities.append(Q)
 
         if len(Quantities) == 0:
             return jsonify('Failed to create order: please select at least on product'), 500
-    except ValueError:
-        return jsonify('Please check: order content must be valid'), 500
-
-    # query product infos
-    db = get_db()
-    db.cursor().execute("DROP TABLE IF EXISTS PID_list")
-    db.cursor().execute("""
-        create temp table PID_list(PID INTEGER PRIMARY KEY)
-    """)
-    for P in PIDs:
-        db.cursor().execute("""
-        insert into PID_list values (?)
-        """, (P, ))
-
-    rst = db.cursor().execute("""
-    select * from PID_list natural join Products
-    """).fetchall()
+    except ValueError:
+        return jsonify('Please check: order content must be valid'), 500
 
-    # decode image + calculate price
+    # query product infos, in the order they were requested, with store and user locations
+    db = get_db()
+    rst = db.cursor().execute(f"""
+        select {MENU_COLUMNS}, S_latitude, S_longitude, U_latitude, U_longitude
+        from json_each(?) as PID_list
+            join Products on PID = PID_list.value
+            join Stores on SID = P_store
+            join Users on UID = ?
+        order by PID_list.key
+    """, (json.dumps(PIDs), session['user_info']['UID'])).fetchall()
+
+    # calculate price
     if len(rst) != len(Quantities):
         return "Product modified by store, please try again!", 500
-    Products = [dict(r) for r in rst]
+    Products = [_menu_entry(zip(r.keys()[:-4], r[:-4])) for r in rst]
 
     Subtotal = 0
     for r, q in zip(Products, Quantities):
-        r['P_image'] = base64.b64encode(r['P_image']).decode()
         r['Order_quantity'] = q
         Subtotal += r['P_price'] * q
 
     # calculate fee
-    lat1, lon1 = db.cursor().execute("select U_latitude, U_longitude from Users where UID = ?",
-                                     (session['user_info']['UID'], )).fetchone()
-    lat2, lon2 = db.cursor().execute("select S_latitude, S_longitude from Stores where S_owner = ?",
-                                     (Products[0]['P_owner'], )).fetchone()
+    lat2, lon2, lat1, lon1 = rst[0][-4:]
     distance = float(_distance_between_locations(lat1, lon1, lat2, lon2))
 
     Delivery_fee = 0 if request.form['Dilivery'] == '0' else max(
         int(round(distance * 10)), 10)
 
-    db.cursor().execute("drop table PID_list")
-
     return jsonify({
         'Products': Products,
         'Subtotal': Subtotal,
@@ -340,7 +1466,7 @@ def order_preview():
     }), 200
 
 
-@app.route("/login", methods=['POST'])
+@bp.route("/login", methods=['POST'])
 def login():
     Account = request.form['Account']
     password = request.form['password']
@@ -357,27 +1483,27 @@ def login():
     if user_info is None:
         # login failed
         flash("Login failed, please try again")
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     else:
         # login successfully
         session['user_info'] = dict(user_info)
-        return redirect(url_for('nav'))
+        return redirect(url_for('.nav'))
 
 
-@app.route("/logout", methods=['POST'])
+@bp.route("/logout", methods=['POST'])
 @login_required
 def logout():
     session['user_info'] = None
     flash("Logged out")
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
 
-@app.route("/sign-up.html")
+@bp.route("/sign-up.html")
 def sign_up():
     return render_template("sign-up.html")
 
 
-@app.route("/register-account-check", methods=['POST'])
+@bp.route("/register-account-check", methods=['POST'])
 def register_account_check():
     '''
     checks if account is already registered
@@ -406,7 +1532,7 @@ def register_account_check():
     return response
 
 
-@app.route("/register", methods=['POST'])
+@bp.route("/register", methods=['POST'])
 def register():
     # get input values
     name = request.form['name']
@@ -420,40 +1546,40 @@ def register():
     if password != request.form['re-password']:
         # sign-up fail
         flash("Please check: password and re-password need to be the same!")
-        return redirect(url_for("sign_up"))
+        return redirect(url_for(".sign_up"))
 
     # check any blanks:
     for k, v in request.form.items():
         if v == '':
             flash(f"Please check: '{k}' is not filled")
-            return redirect(url_for("sign_up"))
+            return redirect(url_for(".sign_up"))
 
     # check formats:
     # account
     for c in Account:
         if not (c.isdigit() or c.isalpha()):
             flash("Please check: Account can only contain letters and numbers")
-            return redirect(url_for("sign_up"))
+            return redirect(url_for(".sign_up"))
 
     # pwd
     for c in password:
         if not (c.isdigit() or c.isalpha()):
             flash("Please check: password can only contain letters and numbers")
-            return redirect(url_for("sign_up"))
+            return redirect(url_for(".sign_up"))
 
     # phone
     if len(phonenumber) != 10 or not phonenumber.isdigit():
         flash("Please check: phone number can only contain 10 digits")
-        return redirect(url_for("sign_up"))
+        return redirect(url_for(".sign_up"))
 
     # name
     if len(name.split()) != 2:
         flash("Please check: please fill in first name and last name")
-        return redirect(url_for("sign_up"))
+        return redirect(url_for(".sign_up"))
     for c in name:
         if not (c.isalpha() or c == ' '):
             flash("Please check: name can only contain letters and spaces")
-            return redirect(url_for("sign_up"))
+            return redirect(url_for(".sign_up"))
 
     # latitude and longitude
     try:
@@ -461,32 +1587,30 @@ def register():
         longitude = float(longitude)
     except ValueError:
         flash("Please check: locations can only be float")
-        return redirect(url_for("sign_up"))
+        return redirect(url_for(".sign_up"))
     if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
         flash("Please check: latitude and longitude must be in range")
-        return redirect(url_for("sign_up"))
+        return redirect(url_for(".sign_up"))
 
     # hash password + salt (account) before storing it
     password = hashlib.sha256((password + Account).encode()).hexdigest()
 
     # store newly registered user informations
-    db = get_db()
     try:
-        db.cursor().execute('''
+        write_transaction(lambda db: db.cursor().execute('''
             insert into Users (U_account, U_password, U_name, U_type, U_latitude, U_longitude, U_phone, U_balance)
             values (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (Account, password, name, 0, latitude, longitude, phonenumber, 0))
+        ''', (Account, password, name, 0, latitude, longitude, phonenumber, 0)))
     except sqlite3.IntegrityError:
         flash("User account is already registered, please try another account")
-        return redirect(url_for("sign_up"))
-    db.commit()
+        return redirect(url_for(".sign_up"))
 
     # Register successfully
     flash("Registered Successfully, you may login now")
-    return redirect(url_for("index"))
+    return redirect(url_for(".index"))
 
 
-@app.route('/get_session', methods=['GET'])
+@bp.route('/get_session', methods=['GET'])
 def get_session():
     if request.method == 'GET':
         data = {}
@@ -499,86 +1623,581 @@ def get_session():
         return jsonify({'user_info': 'nothing'})
 
 
-def search_menu(SID, upper, lower, meal):
+def _text_filter(fts_table, rowid, terms, params):
+    '''
+    returns an SQL condition: every column in terms contains its substring, case insensitively
+    substrings of 3+ characters are looked up in the trigram index fts_table,
+    shorter ones can't be and fall back to instr
+    named parameters used by the condition are added to params
+    '''
+    conditions, match = [], []
+    for column, term in terms.items():
+        if len(term) >= 3:
+            match.append(f'{column} : "' + term.replace('"', '""') + '"')
+        elif term:
+            params[column + '_term'] = term
+            conditions.append(f'instr(lower({column}), lower(:{column}_term)) > 0')
+            # instr(a, b) > 0 means if a contains substring b
+    if match:
+        params[fts_table] = ' AND '.join(match)
+        conditions.append(f'{rowid} in (select rowid from {fts_table} where {fts_table} match :{fts_table})')
+    return ' and '.join(conditions) or '1'
+
+
+def _menu_entry(product):
+    '''
+    converts a Products row (MENU_COLUMNS) into the dict sent to nav.html
+    '''
+    entry = dict(product)
+    # listings show the thumbnail once _submit_image_job has made it
+    digest = entry.pop('P_thumb_hash') or entry['P_image_hash']
+    del entry['P_image_hash']
+    entry['P_image_url'] = url_for('.product_image', PID=entry['PID'], digest=digest)
+    return entry
+
+
+# text SQLite converts to a number when it is compared with an INT column, an integer or real literal
+# surrounded by spaces, anything else (inf, nan, 1_0, hex, non-ASCII digits) stays text
+_SQL_NUMBER = re.compile(r'[ \t\n\v\f\r]*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?[ \t\n\v\f\r]*')
+
+
+def _price_bound(value):
+    '''
+    a price filter of search_shops as a number, compared with P_price like SQLite would:
+    text that isn't a number is greater than every price
+    '''
+    if not isinstance(value, str):
+        return float(value)
+    if _SQL_NUMBER.fullmatch(value) is None:
+        return math.inf
+    return float(value)
+
+
+def _store_menu(db, SID, version, prices=None):
+    '''
+    returns (prices, lowercase names, menu entries) of every product of store SID, sorted by price
+    cached in _menu_cache until MV_version of the store is no longer version
+    prices (from _store_prices) is kept instead of a copy when the products have the same prices,
+    then a price range found in it is also the range of the menu entries
+    '''
+    key = (current_app.config['DATABASE'], SID)
+    cached = _menu_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1:]
+
+    rst = db.cursor().execute(f'''
+        select {MENU_COLUMNS}
+        from Products
+        where P_store = ?
+        order by P_price, PID
+        ''', (SID, )).fetchall()
+    menu_prices = array.array('d', [r['P_price'] for r in rst])
+    if menu_prices == prices:
+        menu_prices = prices
+    menu = (menu_prices, [r['P_name'].lower() for r in rst], [_menu_entry(r) for r in rst])
+    # version was read before the products, so the products are at least that new
+    _menu_cache.put(key, (version, ) + menu, MENU_CACHE_SIZE)
+    return menu
+
+
+def _store_prices(db, SID, version):
+    '''
+    returns the prices of every product of store SID as a sorted array
+    cached in _price_cache until MV_prices of the store is no longer version
+    '''
+    key = (current_app.config['DATABASE'], SID)
+    cached = _price_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # covered by the Products_P_store index
+    rst = db.cursor().execute("select P_price from Products where P_store = ? order by P_price", (SID, ))
+    prices = array.array('d', [price for (price, ) in rst])
+    _price_cache.put(key, (version, prices), PRICE_CACHE_SIZE)
+    return prices
+
+
+def _price_range(prices, upper, lower):
+    '''
+    (start, stop) of the prices of a sorted array in the price range, found by two binary searches
+    '''
+    return bisect.bisect_left(prices, _price_bound(lower)), bisect.bisect_right(prices, _price_bound(upper))
+
+
+def search_menu(SID, upper, lower, meal, version=None, price_version=None):
+    '''
+    products of store SID in the price range whose name contains meal, sorted by price
+    version and price_version are MV_version and MV_prices of the store (looked up if None),
+    used by the menu cache and the price cache
+    '''
     db = get_db()
-    rst = db.cursor().execute('''
-        select *
+    if (MENU_CACHE_SIZE or PRICE_CACHE_SIZE) and (version is None or price_version is None):
+        version, price_version = db.cursor().execute('''
+            select coalesce(MV_version, 0), coalesce(MV_prices, 0)
+            from (select ? as SID) natural left join Menu_Versions
+            ''', (SID, )).fetchone()
+    prices = None
+    if PRICE_CACHE_SIZE:
+        prices = _store_prices(db, SID, price_version)
+        start, stop = _price_range(prices, upper, lower)
+        if start == stop:
+            # nothing in the price range, the menu isn't read
+            return []
+    if MENU_CACHE_SIZE:
+        menu_prices, names, entries = _store_menu(db, SID, version, prices)
+        if menu_prices is not prices:
+            # no price cache, or the prices changed between reading them and the menu
+            start, stop = _price_range(menu_prices, upper, lower)
+        # entries are shared by every search, don't modify them
+        meal = meal.lower()
+        return [entries[i] for i in range(start, stop) if meal in names[i]]
+
+    params = {'SID': SID, 'upper': upper, 'lower': lower}
+    meal_filter = _text_filter('Products_fts', 'PID', {'P_name': meal}, params)
+    rst = db.cursor().execute(f'''
+        select {MENU_COLUMNS}
         from Products
-        where P_store = ? and P_price <= ? and P_price >= ? and instr(lower(P_name), lower(?)) > 0
-        ''', (SID, upper, lower, meal)).fetchall()
-    # instr(a, b) > 0 means if a contains substring b
+        where P_store = :SID and P_price <= :upper and P_price >= :lower and {meal_filter}
+        order by P_price, PID
+        ''', params).fetchall()
 
-    rst = [dict(r) for r in rst]
-    for r in rst:
-        r['P_image'] = base64.b64encode(r['P_image']).decode()
-    return rst
+    return [_menu_entry(r) for r in rst]
 
 
-@app.route("/search-shops", methods=['POST'])
-def search_shops():
-    search = {i: request.form[i] for i in [
-        'shop', 'sel1', 'price_low', 'price_high', 'meal', 'category', 'U_lat', 'U_lon']}
-    desc = 'desc' if request.form["desc"] == 'true' else ''
+def _search_shops(search, ordering, desc):
+    '''
+    returns the response body of search_shops
+    '''
     search['medium'] = DISTANCE_BOUNDARY['medium']
     search['far'] = DISTANCE_BOUNDARY['far']
+
+    # only stores within radius of the user need a distance, with Stores_rtree they are found by a box around
+    # the user, near / medium stores are all within it, stores outside it are known to be far
+    if search['sel1'] == 'near':
+        radius, join = DISTANCE_BOUNDARY['medium'], 'natural join'
+    elif search['sel1'] == 'medium':
+        radius, join = DISTANCE_BOUNDARY['far'], 'natural join'
+    elif ordering == 'dis_rank':
+        # ordering needs the exact distance of every store
+        radius, join = None, 'natural left join'
+    else:
+        radius, join = DISTANCE_BOUNDARY['far'], 'natural left join'
     db = get_db()
-    rst = db.cursor().execute(
-        f'''
-        with dis(SID, gio_dis) as (
-                select SID, _GIO_DIS(S_latitude, S_longitude, :U_lat, :U_lon) as gio_dis
-                from Stores
+    if numpy is not None and NUMPY_DISTANCE:
+        # distances of every store in one vectorized call, SQL gets the SIDs of stores within radius,
+        # near ones first, then medium ones (nearest first if ordered by distance), the position of a store is
+        # its dis_key, stores that aren't passed are far
+        SIDs, distances, buckets = _get_store_locations(db).buckets(search['U_lat'], search['U_lon'])
+        search['near_count'] = int(numpy.count_nonzero(buckets['near']))
+        search['medium_count'] = search['near_count'] + int(numpy.count_nonzero(buckets['medium']))
+        count = {None: len(SIDs), DISTANCE_BOUNDARY['medium']: search['near_count'],
+                 DISTANCE_BOUNDARY['far']: search['medium_count']}[radius]
+        if ordering == 'dis_rank':
+            order = numpy.argsort(distances, kind='stable')
+        else:
+            order = numpy.concatenate([numpy.flatnonzero(buckets['near']), numpy.flatnonzero(buckets['medium'])])
+        search['dis'] = json.dumps(SIDs[order[:count]].tolist())
+        # the integer SID lets SQLite index dis for the left join
+        dis_sql = '''dis(SID, dis_key) as materialized (
+                select cast(value as integer), key
+                from json_each(:dis)
+            )'''
+        distance = '''case
+                        when dis_key is NULL or dis_key >= :medium_count then 'far'
+                        when dis_key >= :near_count then 'medium'
+                        else 'near'
+                    end'''
+        rank = 'dis_key'
+    else:
+        if radius is None:
+            box = (-90, 90, -180, 180)
+        else:
+            box = _bounding_box(search['U_lat'], search['U_lon'], radius)
+        search.update(zip(['min_lat', 'max_lat', 'min_lon', 'max_lon'], box))
+        if SQL_DISTANCE:
+            # the angle to the user is below a boundary if the dot product with the user is above its cosine
+            search.update(zip(['U_x', 'U_y', 'U_z'], _unit_vector(search['U_lat'], search['U_lon'])))
+            medium, far = (math.cos(DISTANCE_BOUNDARY[i] / EARTH_RADIUS) for i in ['medium', 'far'])
+            search.update(near_dot=medium + SQL_DISTANCE_MARGIN, medium_dot_max=medium - SQL_DISTANCE_MARGIN,
+                          medium_dot_min=far + SQL_DISTANCE_MARGIN, far_dot=far - SQL_DISTANCE_MARGIN)
+            dis_key = '''coalesce(S_x * :U_x + S_y * :U_y + S_z * :U_z,
+                        _GIO_DOT(S_latitude, S_longitude, :U_x, :U_y, :U_z))'''
+            distance = '''case
+                            when dis_key is NULL then 'far'
+                            when dis_key > :near_dot then 'near'
+                            when dis_key < :far_dot then 'far'
+                            when dis_key < :medium_dot_max and dis_key > :medium_dot_min then 'medium'
+                            -- too close to a boundary to tell
+                            when cast(_GIO_DIS(S_latitude, S_longitude, :U_lat, :U_lon) as real) >= :far
+                                then 'far'
+                            when cast(_GIO_DIS(S_latitude, S_longitude, :U_lat, :U_lon) as real) >= :medium
+                                then 'medium'
+                            else 'near'
+                        end'''
+            rank = '-dis_key'
+        else:
+            dis_key = 'cast(_GIO_DIS(S_latitude, S_longitude, :U_lat, :U_lon) as real)'
+            distance = '''case
+                            when dis_key is NULL or dis_key >= :far then 'far'
+                            when dis_key >= :medium then 'medium'
+                            else 'near'
+                        end'''
+            rank = 'dis_key'
+        dis_sql = f'''box(SID) as (
+                select SID
+                from Stores_rtree
+                where max_lat >= :min_lat and min_lat <= :max_lat
+                and max_lon >= :min_lon and min_lon <= :max_lon
             ),
-            dis_cat(SID, distance) as (
-                select SID, case
-                    when gio_dis >= :far then 'far'
-                    when gio_dis >= :medium then 'medium'
-                    else 'near'
-                end as distance
-                from Stores natural join dis
+            dis(SID, dis_key) as materialized (
+                select SID, {dis_key}
+                from Stores natural join box
+            )'''
+
+    store_filter = _text_filter('Stores_fts', 'SID', {'S_name': search['shop'], 'S_foodtype': search['category']},
+                                search)
+    meal_filter = _text_filter('Products_fts', 'PID', {'P_name': search['meal']}, search)
+    # dis_key is the position of the store with NumPy, the dot product of unit vectors with SQL_DISTANCE,
+    # the distance without
+    shops_sql = f'''
+        with {dis_sql},
+            shops(SID, S_name, S_foodtype, distance, dis_rank) as (
+                select SID, S_name, S_foodtype, {distance} as distance, {rank}
+                from Stores {join} dis
+                where {store_filter}
+                and distance like :sel1
             )
-
-        select SID, S_name, S_foodtype, distance
-        from Stores natural join dis natural join dis_cat
-        where instr(lower(S_name), lower(:shop)) > 0
-        and instr(lower(S_foodtype), lower(:category)) > 0
-        and distance like :sel1
-        order by {request.form['ordering']}
-        ''' + desc,
-        search
-    ).fetchall()
-    # instr(a, b) > 0 means if a contains substring b
-    # latitude and longitude are checked, ordering is a list(user can only select), so don't worry about SQL injection
+        '''
+    # ordering is looked up in SHOP_ORDERING and join is chosen above, filters only contain parameters,
+    # so don't worry about SQL injection
     table = {'tableRow': []}
     append = table['tableRow'].append
-    for SID, S_name, S_foodtype, distance in rst:
-        menu = search_menu(
-            SID, search['price_high'], search['price_low'], search['meal'])
-        if menu:
+    if SEARCH_SINGLE_PASS:
+        # one query for shops and menus, rows of the same shop are adjacent
+        rst = db.cursor().execute(
+            shops_sql + f'''
+            select shops.SID, S_name, S_foodtype, distance, {MENU_COLUMNS}
+            from shops join Products on P_store = shops.SID
+            where P_price <= :price_high and P_price >= :price_low
+            and {meal_filter}
+            order by {ordering} {desc}, shops.SID, P_price, PID
+            ''',
+            search
+        )
+        for (SID, S_name, S_foodtype, distance), products in itertools.groupby(rst, key=lambda r: r[:4]):
             append({'shop_name': S_name, 'foodtype': S_foodtype, 'distance': distance,
-                    'menu': menu})
-    response = jsonify(table)
+                    'menu': [_menu_entry(zip(r.keys()[4:], r[4:])) for r in products]})
+    else:
+        rst = db.cursor().execute(
+            shops_sql + f'''
+            select SID, S_name, S_foodtype, distance, coalesce(MV_version, 0), coalesce(MV_prices, 0)
+            from shops natural left join Menu_Versions
+            order by {ordering} {desc}
+            ''',
+            search
+        ).fetchall()
+        for SID, S_name, S_foodtype, distance, version, price_version in rst:
+            # stores without a product in the price range are skipped by the price cache
+            menu = search_menu(
+                SID, search['price_high'], search['price_low'], search['meal'], version, price_version)
+            if menu:
+                append({'shop_name': S_name, 'foodtype': S_foodtype, 'distance': distance,
+                        'menu': menu})
+    return jsonify(table).get_data()
+
+
+def _search_cache_key(search, ordering, desc):
+    '''
+    returns the search_shops cache key of a search, None if it can't be cached
+    the key ends with the grid cell (SEARCH_CACHE_CELL) of the user
+    '''
+    try:
+        cell = (round(float(search['U_lat']) / SEARCH_CACHE_CELL), round(float(search['U_lon']) / SEARCH_CACHE_CELL))
+    except (ValueError, OverflowError):
+        return None
+    # text filters are case insensitive, SQLite lower() only folds ASCII
+    terms = tuple(search[i].lower() if search[i].isascii() else search[i] for i in ['shop', 'category', 'meal'])
+    prices = _price_bound(search['price_low']), _price_bound(search['price_high'])
+    return (current_app.config['DATABASE'], search['sel1'], ordering, desc) + terms + prices + cell
+
+
+def _cached_search(key, search, ordering, desc):
+    '''
+    returns the response body of search_shops from _search_cache, searching on a miss
+    '''
+    now = time.monotonic()
+    entry = _search_cache.get(key)
+    with _search_cache_lock:
+        if entry is not None and now < entry[0]:
+            _search_cache_stats['hits'] += 1
+            return entry[1]
+        if entry is not None and now < entry[0] + SEARCH_CACHE_STALE:
+            _search_cache_stats['stale'] += 1
+            refresh, entry[2] = not entry[2], True
+        else:
+            _search_cache_stats['misses'] += 1
+            entry = None
+
+    if entry is None:
+        return _store_search(key, _search_shops(search, ordering, desc))
+
+    if refresh:
+        @copy_current_request_context
+        def job():
+            try:
+                _store_search(key, _search_shops(search, ordering, desc))
+            finally:
+                entry[2] = False
+        _background_executor('search', 1).submit(job)
+    return entry[1]
+
+
+def _store_search(key, body):
+    '''
+    adds a search_shops response body to _search_cache, returns body
+    '''
+    evicted = _search_cache.put(key, [time.monotonic() + SEARCH_CACHE_TTL, body, False], SEARCH_CACHE_SIZE)
+    if evicted:
+        with _search_cache_lock:
+            _search_cache_stats['evictions'] += evicted
+    return body
+
+
+@bp.route("/search-shops", methods=['POST'])
+def search_shops():
+    search = {i: request.form[i] for i in [
+        'shop', 'sel1', 'price_low', 'price_high', 'meal', 'category', 'U_lat', 'U_lon']}
+    desc = 'desc' if request.form["desc"] == 'true' else ''
+    ordering = SHOP_ORDERING[request.form['ordering']]
+    key = _search_cache_key(search, ordering, desc) if SEARCH_CACHE_TTL else None
+    if key is None:
+        body = _search_shops(search, ordering, desc)
+    else:
+        search['U_lat'], search['U_lon'] = key[-2] * SEARCH_CACHE_CELL, key[-1] * SEARCH_CACHE_CELL
+        body = _cached_search(key, search, ordering, desc)
+    response = current_app.response_class(body, mimetype='application/json')
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.status_code = 200
     return response
 
 
-@app.route("/order-detail", methods=['POST'])
+def _nearest_shops(search, K):
+    '''
+    returns up to K shops with a product matching the filters of search, nearest to (U_lat, U_lon) first
+    stores are read from Stores_rtree in boxes of doubling radius around the user, and a store's menu is only
+    filtered once every nearer store has been, so the search stops at the K-th shop found
+    '''
+    db = get_db()
+    lat, lon = float(search['U_lat']), float(search['U_lon'])
+    store_filter = _text_filter('Stores_fts', 'SID', {'S_name': search['shop'], 'S_foodtype': search['category']},
+                                search)
+    # stores read but not filtered yet, (distance, SID, S_name, S_foodtype, MV_version, MV_prices)
+    candidates = []
+    shops = []
+    # nothing has been read, min > max
+    search.update(seen_min_lat=1, seen_max_lat=0, seen_min_lon=1, seen_max_lon=0)
+    radius = NEAREST_SHOPS_RADIUS
+    while True:
+        box = _bounding_box(lat, lon, radius)
+        search.update(zip(['min_lat', 'max_lat', 'min_lon', 'max_lon'], box))
+        # stores in the box but not in the previous one, filtered by name and category
+        rst = db.cursor().execute(f'''
+            select SID, S_name, S_foodtype, S_latitude, S_longitude, coalesce(MV_version, 0), coalesce(MV_prices, 0)
+            from Stores_rtree natural join Stores natural left join Menu_Versions
+            where max_lat >= :min_lat and min_lat <= :max_lat
+            and max_lon >= :min_lon and min_lon <= :max_lon
+            and not (max_lat >= :seen_min_lat and min_lat <= :seen_max_lat
+                     and max_lon >= :seen_min_lon and min_lon <= :seen_max_lon)
+            and {store_filter}
+            ''', search)
+        for SID, S_name, S_foodtype, S_lat, S_lon, *versions in rst:
+            distance = float(_distance_between_locations(S_lat, S_lon, lat, lon))
+            heapq.heappush(candidates, (distance, SID, S_name, S_foodtype, *versions))
+
+        # every store within radius is in the box, and in the last box every store is
+        everything = box == (-90, 90, -180, 180)
+        while candidates and (everything or candidates[0][0] <= radius):
+            distance, SID, S_name, S_foodtype, *versions = heapq.heappop(candidates)
+            menu = search_menu(SID, search['price_high'], search['price_low'], search['meal'], *versions)
+            if not menu:
+                continue
+            if distance >= DISTANCE_BOUNDARY['far']:
+                label = 'far'
+            elif distance >= DISTANCE_BOUNDARY['medium']:
+                label = 'medium'
+            else:
+                label = 'near'
+            shops.append({'shop_name': S_name, 'foodtype': S_foodtype, 'distance': label,
+                          'distance_km': distance, 'menu': menu})
+            if len(shops) == K:
+                return shops
+        if everything:
+            return shops
+        search.update(zip(['seen_min_lat', 'seen_max_lat', 'seen_min_lon', 'seen_max_lon'], box))
+        radius *= 2
+
+
+@bp.route("/nearest-shops", methods=['POST'])
+def nearest_shops():
+    '''
+    the K shops nearest to the user that sell a product matching the filters, nearest first
+    form fields (all optional):
+        K                       number of shops, NEAREST_SHOPS_K by default, at most NEAREST_SHOPS_MAX
+        shop, category, meal    substrings of the shop name, food type and product name
+        price_low, price_high   price range of the products
+        U_lat, U_lon            location of the user, the saved location of the logged in user by default
+    '''
+    search = {i: request.form.get(i, '') for i in ['shop', 'category', 'meal']}
+    search['price_low'] = request.form.get('price_low', -math.inf)
+    search['price_high'] = request.form.get('price_high', math.inf)
+    K = min(max(request.form.get('K', NEAREST_SHOPS_K, type=int), 1), NEAREST_SHOPS_MAX)
+    if 'U_lat' in request.form and 'U_lon' in request.form:
+        search['U_lat'], search['U_lon'] = request.form['U_lat'], request.form['U_lon']
+    elif session.get('user_info'):
+        search['U_lat'], search['U_lon'] = get_db().cursor().execute(
+            "select U_latitude, U_longitude from Users where UID = ?", (session['user_info']['UID'], )).fetchone()
+    else:
+        search['U_lat'] = search['U_lon'] = None
+    try:
+        location = float(search['U_lat']), float(search['U_lon'])
+    except (TypeError, ValueError):
+        location = (math.nan, )
+    if not all(map(math.isfinite, location)):
+        response = jsonify({'message': 'U_lat and U_lon must be numbers, they are required when not logged in'})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 400
+
+    response = jsonify({'tableRow': _nearest_shops(search, K)})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+def _local_request():
+    '''
+    true if the request comes from this host, statistics are only answered to local requests
+    '''
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+@bp.route("/search-cache-stats")
+def search_cache_stats():
+    '''
+    hit / miss counters of the search_shops cache, only answered to local requests
+    '''
+    if not _local_request():
+        return make_response('', 404)
+    with _search_cache_lock:
+        stats = dict(_search_cache_stats, size=len(_search_cache))
+    response = jsonify(stats)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+@bp.route("/product-image/<int:PID>/<digest>")
+def product_image(PID, digest):
+    '''
+    serves product images and their IMAGE_VARIANTS
+    urls contain the image hash, so a url always refers to the same image
+    '''
+    if digest in request.if_none_match:
+        # cached copy can only be this image
+        response = make_response('', 304)
+    else:
+        db = get_db()
+        rst = db.cursor().execute('''
+            select PI_image as image, PI_imagetype as imagetype
+            from Product_Images
+            where PID = ? and PI_hash = ?
+            ''', (PID, digest)).fetchone()
+        if rst is not None:
+            image = rst['image']
+        else:
+            # uploaded image
+            rst = db.cursor().execute('''
+                select P_image as image, P_imagetype as imagetype
+                from Products
+                where PID = ? and P_image_hash = ?
+                ''', (PID, digest)).fetchone()
+            if rst is not None:
+                image = base64.b64decode(rst['image'])
+            else:
+                # image of an ordered product that was deleted since
+                rst = db.cursor().execute('''
+                    select SI_image as image, SI_imagetype as imagetype
+                    from Snapshot_Images
+                    where SI_hash = ?
+                    ''', (digest, )).fetchone()
+                if rst is None:
+                    return 'image not found', 404
+                image = rst['image']
+        response = make_response(image)
+        response.mimetype = mimetypes.guess_type(
+            'image.' + rst['imagetype'])[0] or 'application/octet-stream'
+    response.set_etag(digest)
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    return response
+
+
+@bp.route("/order-detail", methods=['POST'])
 def order_detail():
     OID = request.form['OID']
-    db = get_db()
-    details_str = db.cursor().execute(
-        'select O_details from Orders where OID = ?', (OID, )).fetchone()[0]
-    details = json.loads(details_str)
+    details = _load_order_details(get_db(), OID)
+    if details is None:
+        return jsonify('Order not found'), 500
     return jsonify(details), 200
 
 
-@app.route("/search-MyOrders", methods=['POST'])
+def _order_history(query, params):
+    '''
+    responds with the orders query selects, newest first
+    form fields:
+        status  one of ORDER_STATUS, or All
+        before  only orders older than this OID, the next of the previous page
+        limit   page size, at most ORDER_PAGE_MAX
+        export  true: all orders (from before on) in one streamed response instead of a page
+    query selects OID, Status, start_time, end_time, S_name, O_amount ordered by OID desc,
+    {status_filter} in it is replaced with the status condition, and it must use :before and :limit
+    '''
+    status = request.form.get('status', 'All')
+    export = request.form.get('export') == 'true'
+    params['before'] = request.form.get('before', type=int)
+    params['limit'] = -1 if export else min(max(request.form.get('limit', ORDER_PAGE_SIZE, type=int), 1),
+                                            ORDER_PAGE_MAX)  # -1: no limit
+    status_filter = ''
+    if status in ORDER_STATUS:
+        params['status'] = ORDER_STATUS[status]
+        status_filter = 'and O_status = :status'
+    # status_filter is one of two constants, so don't worry about SQL injection
+    rst = get_db().cursor().execute(query.format(status_filter=status_filter), params)
+
+    def order(row):
+        OID, Status, start_time, end_time, S_name, O_amount = row
+        return {'Status': Status, 'start_time': start_time, 'end_time': end_time, 'S_name': S_name,
+                'OID': OID, 'total_price': O_amount}
+
+    if export:
+        # rows are read from the cursor as they are sent, memory use doesn't grow with the history
+        def rows():
+            yield '{"tableRow": ['
+            for i, row in enumerate(rst):
+                yield (',' if i else '') + json.dumps(order(row))
+            yield '], "next": null}'
+        response = Response(stream_with_context(rows()), mimetype='application/json')
+    else:
+        table = {'tableRow': [order(row) for row in rst]}
+        table['next'] = table['tableRow'][-1]['OID'] if len(table['tableRow']) == params['limit'] else None
+        response = jsonify(table)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.status_code = 200
+    return response
+
+
+@bp.route("/search-MyOrders", methods=['POST'])
 def search_MyOrders():
     UID = int(request.form['UID'])
-    db = get_db()
-    rst = db.cursor().execute(
+    return _order_history(
         '''
-        select 
+        select OID,
             case
                 when O_status = 0 then 'Not finished'
                 when O_status = 1 then 'Finished'
@@ -588,24 +2207,15 @@ def search_MyOrders():
             case
                 when O_end_time is not NULL then strftime('%Y/%m/%d %H:%M', O_end_time)
                 else ''
-            end as end_time, S_name, OID, O_amount
+            end as end_time, S_name, O_amount
         from Process_Order natural join Orders natural join Stores
-        where UID = ?
-        ''', (UID,)
-    ).fetchall()
-    table = {'tableRow': []}
-    append = table['tableRow'].append
-    for Status, start_time, end_time, S_name, OID, O_amount in rst:
-        append({'Status': Status, 'start_time': start_time, 'end_time': end_time, 'S_name': S_name,
-                'OID': OID, 'total_price': O_amount})
-    print(table['tableRow'])
-    response = jsonify(table)
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.status_code = 200
-    return response
+        where UID = :UID and OID < coalesce(:before, 9223372036854775807) {status_filter}
+        order by OID desc
+        limit :limit
+        ''', {'UID': UID})
 
 
-@app.route('/search-ShopOrders', methods=['POST'])
+@bp.route('/search-ShopOrders', methods=['POST'])
 def search_ShopOrders():
     UID = int(request.form['UID'])
     db = get_db()
@@ -616,58 +2226,50 @@ def search_ShopOrders():
         where S_owner = ?
         ''', (UID,)
     ).fetchone()
-    table = {'tableRow': []}
-    append = table['tableRow'].append
-    if rst is not None:
-        SID = rst
-        rst = db.cursor().execute(
-            '''
-            select OID,
-                case
-                    when O_status = 0 then 'Not finished'
-                    when O_status = 1 then 'Finished'
-                    else 'Canceled'
-                end as Status,
-                strftime('%Y/%m/%d %H:%M', O_start_time) as start_time, 
-                case
-                    when O_end_time is not NULL then strftime('%Y/%m/%d %H:%M', O_end_time)
-                    else ''
-                end as end_time,
-                S_name, O_amount
-            from Orders natural join Stores
-            where SID = ?
-            ''', (SID[0],)
-        ).fetchall()
-        for OID, Status, start_time, end_time, S_name, O_amount in rst:
-            append({'Status': Status, 'start_time': start_time, 'end_time': end_time, 'S_name': S_name,
-                    'OID': OID, 'total_price': O_amount})
-    print(table['tableRow'])
-    response = jsonify(table)
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.status_code = 200
-    return response
+    SID = rst[0] if rst is not None else None  # no orders without a store
+    # orders of the store are read from the Orders(SID) or (SID, O_status) index already sorted by OID
+    return _order_history(
+        '''
+        select OID,
+            case
+                when O_status = 0 then 'Not finished'
+                when O_status = 1 then 'Finished'
+                else 'Canceled'
+            end as Status,
+            strftime('%Y/%m/%d %H:%M', O_start_time) as start_time, 
+            case
+                when O_end_time is not NULL then strftime('%Y/%m/%d %H:%M', O_end_time)
+                else ''
+            end as end_time,
+            S_name, O_amount
+        from Orders natural join Stores
+        where SID = :SID and OID < coalesce(:before, 9223372036854775807) {status_filter}
+        order by OID desc
+        limit :limit
+        ''', {'SID': SID})
 
 
-@app.route("/search-transactionRecord", methods=['POST'])
+@bp.route("/search-transactionRecord", methods=['POST'])
 def search_transactionRecord():
+    '''
+    one page of the transaction records of UID, newest first
+    records older than TID before are returned if before is given,
+    the response's next is the before of the next page (null on the last page)
+    '''
     UID = request.form['UID']
+    before = request.form.get('before', type=int)
+    limit = request.form.get('limit', TRANSACTION_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), TRANSACTION_PAGE_MAX)
     db = get_db()
+    # page is picked from the (T_Subject, TID) index before any name is looked up
     rst = db.cursor().execute(
         '''
-        with Shop_Name(TID, S_name) as (
-                select TID, S_name 
-                from Transaction_Record left join Stores
-                on T_Object = S_owner
-            ),
-            Subj_Name(TID, Subj_name) as (
-                select TID, U_name as Subj_name
-                from Transaction_Record, Users
-                where T_Subject = UID
-            ),
-            Obj_Name(TID, Obj_name) as (
-                select TID, U_name as Obj_name
-                from Transaction_Record, Users
-                where T_Object = UID
+        with page as (
+                select *
+                from Transaction_Record
+                where T_Subject = :UID and TID < coalesce(:before, 9223372036854775807)
+                order by TID desc
+                limit :limit
             )
         select TID, 
             case 
@@ -677,28 +2279,30 @@ def search_transactionRecord():
             end as Action, 
             strftime('%Y/%m/%d %H:%M', T_time) as Time,
             case
-                when T_action = 2 then Subj_name
-                when T_action = 1 and is_refund = 0 then Obj_name
+                when T_action = 2 then Subj.U_name
+                when T_action = 1 and is_refund = 0 then Obj.U_name
                 when T_action = 1 and is_refund = 1 then S_name
                 when T_action = 0 and is_refund = 0 then S_name
-                when T_action = 0 and is_refund = 1 then Obj_name
+                when T_action = 0 and is_refund = 1 then Obj.U_name
             end as Trader,
             T_amount
-        from Transaction_Record natural join Subj_Name natural join Obj_Name natural join Shop_Name
-        where T_Subject = ?
-        ''', (UID,)
+        from page
+            join Users as Subj on Subj.UID = T_Subject
+            join Users as Obj on Obj.UID = T_Object
+            left join Stores on S_owner = T_Object
+        order by TID desc
+        ''', {'UID': UID, 'before': before, 'limit': limit}
     ).fetchall()
     transaction = [{'TID': TID, 'Action': Action, 'Time': Time, 'Trader': Trader, 'T_amount': T_amount}
                    for TID, Action, Time, Trader, T_amount in rst]
-    table = {'tableRow': transaction}
-    print(table['tableRow'])
+    table = {'tableRow': transaction, 'next': transaction[-1]['TID'] if len(transaction) == limit else None}
     response = jsonify(table)
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.status_code = 200
     return response
 
 
-@app.route("/order-delete", methods=['POST'])
+@bp.route("/order-delete", methods=['POST'])
 def order_delete():
     delete_OID = int(request.form['OID'])
     is_shopowner = request.form['is_shopowner']
@@ -725,15 +2329,13 @@ def order_delete():
 
     if rst is None:
         return jsonify('Order not found'), 500
-    try:
-        # check if order is finished
-        if rst['O_status'] == 0:
-            # update order status to 'calceled'
-            db.cursor().execute(
-                'update Orders set O_status = -1 where OID = ?', (delete_OID, )
-            )
-        else:
-            return jsonify('Order is already finished / canceled'), 500
+
+    def cancel_order(db):
+        # check if order is finished, update order status to 'calceled'
+        if db.cursor().execute(
+            'update Orders set O_status = -1 where OID = ? and O_status = 0', (delete_OID, )
+        ).rowcount == 0:
+            raise AbortTransaction('Order is already finished / canceled')
         # update process order status to 'owner canceled' or 'user canceled'
         if is_shopowner == 'true':
             print("Shopowner cancels order")
@@ -762,49 +2364,35 @@ def order_delete():
         db.cursor().execute('''
             update Users set U_balance = U_balance + ? where UID = ?
         ''', (rst['O_amount'], customer_ID))
-        db.cursor().execute('''
-            update Users set U_balance = U_balance - ? where UID = ?
-        ''', (rst['O_amount'], shop_owner_ID))
+        if not _credit_shop_owner(db, shop_owner_ID, -rst['O_amount']):
+            raise AbortTransaction("cancel order failed: shop owner's balance is insufficient")
 
-        # update product quantity
-        rst = db.cursor().execute('''
-            select O_details
-            from Orders
-            where OID = ?
-        ''', (delete_OID, )).fetchone()[0]
-        product_details = json.loads(rst)['Products']
-        # get all PIDs and Quantities
-        PIDs = []
-        Quantities = []
-        for product in product_details:
-            print(product.keys())
-            PIDs.append(product['PID'])
-            Quantities.append(product['Order_quantity'])
-
-        # add quantity back to product, Note: if PID doesn't exist, this function does nothing(no error)
-        for PID, quantity in zip(PIDs, Quantities):
-            print(PID, quantity)
-            db.cursor().execute(
-                'update Products set P_quantity = P_quantity + ? where PID = ?', (
-                    quantity, PID)
-            )
+        # add quantity back to product, Note: deleted products are skipped (no error)
+        db.cursor().execute('''
+            update Products
+            set P_quantity = P_quantity + (
+                select OI_quantity from Order_Items where OID = :OID and PID = Products.PID)
+            where PID in (select PID from Order_Items where OID = :OID)
+        ''', {'OID': delete_OID})
 
+    try:
+        write_transaction(cancel_order)
+    except AbortTransaction as e:
+        return jsonify(str(e)), 500
     except Exception as e:
         print("ERROR : " + str(e))
-        db.rollback()
         response = jsonify('cancel order failed')
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.status_code = 500
         return response
 
-    db.commit()
     response = jsonify({'msg': 'cancel order successfully'})
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.status_code = 200
     return response
 
 
-@app.route("/order-complete", methods=['POST'])
+@bp.route("/order-complete", methods=['POST'])
 def order_complete():
     complete_OID = int(request.form['OID'])
     print("complete_OID: ", complete_OID)
@@ -831,15 +2419,13 @@ def order_complete():
 
     if rst is None:
         return jsonify('Order not found'), 500
-    try:
-        # check if order is finished
-        if rst['O_status'] == 0:
-            # update order status to 'completed' and set end time
-            db.cursor().execute('''
-                update Orders set O_status = 1, O_end_time = datetime('now', 'localtime') where OID = ?
-                ''', (complete_OID, ))
-        else:
-            return jsonify('Order is already finished / canceled'), 500
+
+    def complete_order(db):
+        # check if order is finished, update order status to 'completed' and set end time
+        if db.cursor().execute('''
+            update Orders set O_status = 1, O_end_time = datetime('now', 'localtime') where OID = ? and O_status = 0
+            ''', (complete_OID, )).rowcount == 0:
+            raise AbortTransaction('Order is already finished / canceled')
 
         # update process order status to 'order completed'
         db.cursor().execute(
@@ -847,21 +2433,23 @@ def order_complete():
                 complete_OID, )
         )
 
-    except:
-        db.rollback()
+    try:
+        write_transaction(complete_order)
+    except AbortTransaction as e:
+        return jsonify(str(e)), 500
+    except Exception:
         response = jsonify('complete order failed')
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.status_code = 500
         return response
 
-    db.commit()
     response = jsonify({'msg': 'complete order successfully'})
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.status_code = 200
     return response
 
 
-@app.route("/nav.html")
+@bp.route("/nav.html")
 @login_required
 def nav():
     # update session info every time
@@ -869,7 +2457,7 @@ def nav():
     UID = user_info['UID']
     db = get_db()
     user_info = db.cursor().execute(
-        """ select *
+        """ select *, (select coalesce(sum(PC_amount), 0) from Pending_Credits where UID = Users.UID) as U_pending
             from Users
             where UID = ?""", (UID,)
     ).fetchone()
@@ -884,17 +2472,15 @@ def nav():
 
     # fetch product_info
     product_info = db.cursor().execute(
-        """ select *
+        f""" select {MENU_COLUMNS}
             from Products
             where P_owner = ?""", (UID,)
     ).fetchall()
 
-    image_info = [tple['P_image'].decode("utf-8") for tple in product_info]
-
-    return render_template("nav.html", user_info=user_info, shop_info=shop_info, product_info=product_info, image_info=image_info)
+    return render_template("nav.html", user_info=user_info, shop_info=shop_info, product_info=product_info)
 
 
-@app.route("/edit_location", methods=['POST'])
+@bp.route("/edit_location", methods=['POST'])
 @login_required
 def edit_location():
     user_info = session.get('user_info')
@@ -906,32 +2492,30 @@ def edit_location():
     for k, v in request.form.items():
         if v == '':
             flash(f"Please check: '{k}' is not filled")
-            return redirect(url_for("nav"))
+            return redirect(url_for(".nav"))
 
     # check validity
     try:
         latitude, longitude = float(latitude), float(longitude)
     except ValueError:
         flash("Please check: locations can only be float")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     if not (-90 <= int(latitude) <= 90 and -180 <= int(longitude) <= 180):
         flash("Please check: locations not possible")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # update location
-    db = get_db()
-    db.cursor().execute("""
+    write_transaction(lambda db: db.cursor().execute("""
         update Users
         set U_latitude = ?, U_longitude = ?
         where UID = ?
-    """, (latitude, longitude, UID))
-    db.commit()
+    """, (latitude, longitude, UID)))
 
-    return redirect(url_for('nav'))
+    return redirect(url_for('.nav'))
 
 
-@app.route("/shop_register", methods=['POST'])
+@bp.route("/shop_register", methods=['POST'])
 @login_required
 def shop_register():
     # get input values
@@ -947,7 +2531,7 @@ def shop_register():
     for k, v in request.form.items():
         if v == '':
             flash(f"Please check: '{k}' is not filled")
-            return redirect(url_for("nav"))
+            return redirect(url_for(".nav"))
 
     # check formats:
     # latitude and longitude
@@ -956,46 +2540,39 @@ def shop_register():
         longitude = float(shop_longitude)
     except ValueError:
         flash("Please check: locations can only be float")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
         flash("Please check: locations not possible")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # store newly registered store informations
-    db = get_db()
-    try:
-        shop_info = db.cursor().execute('''
-            insert into Stores (S_name, S_latitude, S_longitude, S_phone, S_foodtype, S_owner)
-            values (?, ?, ?, ?, ?, ?)
-        ''', (shop_name, latitude, longitude, owner_phone, shop_category, UID))
+    def register_shop(db):
+        db.cursor().execute('''
+            insert into Stores (S_name, S_latitude, S_longitude, S_phone, S_foodtype, S_owner, S_x, S_y, S_z)
+            values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (shop_name, latitude, longitude, owner_phone, shop_category, UID, *_unit_vector(latitude, longitude)))
         # print(shop_name, latitude, longitude, owner_phone, shop_category, UID)
-    except sqlite3.IntegrityError:
-        flash("shop name has been registered !!")
-        return redirect(url_for("nav"))
-    session['shop_info'] = dict(shop_info)
-    db.commit()
 
-    # change user's type to owner
-    db = get_db()
-    try:
-        user_info = db.cursor().execute('''
+        # change user's type to owner
+        db.cursor().execute('''
             update Users
             set U_type = ?
             where UID = ?
         ''', (1, UID))
+
+    try:
+        write_transaction(register_shop)
     except sqlite3.IntegrityError:
-        flash("show owner update failed")
-        return redirect(url_for("nav"))
-    # session['user_info'] = dict(user_info)
-    db.commit()
+        flash("shop name has been registered !!")
+        return redirect(url_for(".nav"))
 
     # Register successfully
     flash("Shop registered successfully")
-    return redirect(url_for("nav"))
+    return redirect(url_for(".nav"))
 
 
-@app.route("/register-shop_name-check", methods=['POST'])
+@bp.route("/register-shop_name-check", methods=['POST'])
 def register_shop_name_check():
     '''
     checks if shop_name is already registered
@@ -1024,7 +2601,7 @@ def register_shop_name_check():
     return response
 
 
-@app.route("/shop_add", methods=['POST'])
+@bp.route("/shop_add", methods=['POST'])
 @login_required
 def shop_add():
     # get input values
@@ -1038,7 +2615,7 @@ def shop_add():
     # check if user is owner
     if(user_info['U_type'] == 0):
         flash("Please register your store first")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # fetch shop_info
     db = get_db()
@@ -1053,40 +2630,44 @@ def shop_add():
     for k, v in request.form.items():
         if v == '':
             flash(f"Please check: '{k}' is not filled")
-            return redirect(url_for("nav"))
+            return redirect(url_for(".nav"))
     if(meal_pic.filename == ''):
         flash("Please upload a picture for the product")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # get the extension of the file ex: png, jpeg
     meal_pic_extension = meal_pic.filename.split('.')[1]
+    meal_pic = meal_pic.read()
 
     # check formats:
     # price and quantity
     if(int(meal_price) < 0 or int(meal_quantity) < 0):
         flash("Please check: price and quantity can only be non-negatives")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # store newly added product informations
-    db = get_db()
     try:
-        db.cursor().execute('''
-            insert into Products (P_name, P_price, P_quantity, P_image, P_imagetype, P_owner, P_store)
-            values (?, ?, ?, ?, ?, ?, ?)
-        ''', (meal_name, meal_price, meal_quantity, base64.b64encode(meal_pic.read()), meal_pic_extension, UID, SID))
+        PID = write_transaction(lambda db: db.cursor().execute('''
+            insert into Products (P_name, P_price, P_quantity, P_image, P_imagetype, P_image_hash, P_owner, P_store)
+            values (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (meal_name, meal_price, meal_quantity, base64.b64encode(meal_pic), meal_pic_extension,
+              _image_hash(meal_pic), UID, SID)).lastrowid)
     except sqlite3.IntegrityError:
         # print("something went wrong!!")
         flash(" oops something went wrong!!")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
     # session['product_info'] = dict(product_info)       # not sure if needed
-    db.commit()
+
+    # thumbnails are made in the background, listings use the uploaded image until then
+    if Image is not None:
+        _submit_image_job(PID, meal_pic)
 
     # Register successfully
     flash("Product added successfully")
-    return redirect(url_for("nav"))
+    return redirect(url_for(".nav"))
 
 
-@app.route("/edit_price_and_quantity", methods=['POST'])
+@bp.route("/edit_price_and_quantity", methods=['POST'])
 def edit_price_and_quantity():
     edit_price = request.form['edit_price']
     edit_quantity = request.form['edit_quantity']
@@ -1096,51 +2677,69 @@ def edit_price_and_quantity():
     for k, v in request.form.items():
         if v == '':
             flash(f"Please check: '{k}' is not filled")
-            return redirect(url_for("nav"))
+            return redirect(url_for(".nav"))
 
     try:
         int(edit_price)
         int(edit_quantity)
     except ValueError:
         flash("Invalid Value")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # check formats:
     # price and quantity
     if(int(edit_price) < 0 or int(edit_quantity) < 0):
         flash("Please check: price and quantity can only be non-negatives")
-        return redirect(url_for("nav"))
+        return redirect(url_for(".nav"))
 
     # update price & quantity
-    db = get_db()
-    db.cursor().execute("""
+    write_transaction(lambda db: db.cursor().execute("""
         update Products
         set P_price = ?, P_quantity = ?
         where PID = ?
-    """, (edit_price, edit_quantity, edit_PID))
-    db.commit()
+    """, (edit_price, edit_quantity, edit_PID)))
 
     flash("Edit Successful")
-    return redirect(url_for('nav'))
+    return redirect(url_for('.nav'))
 
 
-@app.route("/delete_product", methods=['POST'])
+@bp.route("/delete_product", methods=['POST'])
 def delete_product():
     delete_PID = request.form['delete_PID']
 
-    # delete product from Products db
-    db = get_db()
-    db.cursor().execute("""
-        delete from Products
-        where PID = ?
-    """, (delete_PID,))
-    db.commit()
+    def remove_product(db):
+        # keep its images if order details show them
+        if db.cursor().execute("select 1 from Order_Items where PID = ? limit 1", (delete_PID, )).fetchone():
+            db.cursor().execute("""
+                insert or ignore into Snapshot_Images (SI_hash, SI_image, SI_imagetype)
+                select PI_hash, PI_image, PI_imagetype
+                from Product_Images
+                where PID = ?
+            """, (delete_PID, ))
+            rst = db.cursor().execute("""
+                select P_image_hash, P_image, P_imagetype
+                from Products
+                where PID = ?
+            """, (delete_PID, )).fetchone()
+            if rst is not None:
+                db.cursor().execute("""
+                    insert or ignore into Snapshot_Images (SI_hash, SI_image, SI_imagetype)
+                    values (?, ?, ?)
+                """, (rst[0], base64.b64decode(rst[1]), rst[2]))
+
+        # delete product from Products db
+        db.cursor().execute("""
+            delete from Products
+            where PID = ?
+        """, (delete_PID,))
+
+    write_transaction(remove_product)
 
     flash("Delete Successful")
-    return redirect(url_for('nav'))
+    return redirect(url_for('.nav'))
 
 
-@app.route('/top_up', methods=['POST'])
+@bp.route('/top_up', methods=['POST'])
 @login_required
 def top_up():
     UID = session['user_info']['UID']
@@ -1148,41 +2747,185 @@ def top_up():
         value = int(request.form['value'])
         if value <= 0:
             flash('Invalid value')
-            return redirect(url_for('nav'))
+            return redirect(url_for('.nav'))
     except ValueError:
         flash('Invalid value')
-        return redirect(url_for('nav'))
+        return redirect(url_for('.nav'))
 
-    db = get_db()
-    # update Users
-    db.cursor().execute("""
-        update Users
-        set U_balance = U_balance + ?
-        where UID = ?
-    """, (value, UID))
+    def add_value(db):
+        # update Users
+        db.cursor().execute("""
+            update Users
+            set U_balance = U_balance + ?
+            where UID = ?
+        """, (value, UID))
 
-    # update Transaction_Record
-    db.cursor().execute("""
-        insert into Transaction_Record(T_action, T_amount, T_Subject, T_Object)
-        values (?, ?, ?, ?)
-    """, (2, value, UID, UID))
+        # update Transaction_Record
+        db.cursor().execute("""
+            insert into Transaction_Record(T_action, T_amount, T_Subject, T_Object)
+            values (?, ?, ?, ?)
+        """, (2, value, UID, UID))
 
-    db.commit()
+    write_transaction(add_value)
 
     flash('Top-up successful')
-    return redirect(url_for('nav'))
+    return redirect(url_for('.nav'))
+
+
+@bp.before_app_request
+def _start_request_metrics():
+    if METRICS:
+        request.metrics_start = time.perf_counter()
+        request.sql_metrics = [0, 0.0, 0]  # statements, seconds, rows, see _Cursor
+
+
+@bp.after_app_request
+def _record_request_metrics(response):
+    '''
+    adds the request to METRICS, streamed responses are recorded before their body is sent
+    '''
+    start = getattr(request, 'metrics_start', None)
+    if start is None:
+        return response
+    latency = time.perf_counter() - start
+    route = (('route', _request_route()), )
+    statements, seconds, rows = request.sql_metrics
+    with _metrics_lock:
+        _http_requests.inc(route + (('method', request.method), ('status', response.status_code)))
+        _http_latency.observe(route + (('method', request.method), ), latency)
+        _http_bytes.inc(route, response.content_length or 0)
+        _sql_statements.observe(route, statements)
+        _sql_seconds.observe(route, seconds)
+        _sql_rows.inc(route, rows)
+    return response
+
+
+@bp.route("/metrics")
+def metrics():
+    '''
+    METRICS of this process and cache statistics in Prometheus text format, only answered to local requests
+    '''
+    if not _local_request():
+        return make_response('', 404)
+    lines = []
+    with _metrics_lock:
+        for metric in _metrics:
+            metric.render(lines)
+    with _search_cache_lock:
+        search_cache = _Metric('search_cache_events_total', 'search_shops cache lookups and evictions')
+        for event, count in _search_cache_stats.items():
+            search_cache.inc((('event', event), ), count)
+        search_cache_size = _Metric('search_cache_entries', 'search_shops results cached', 'gauge')
+        search_cache_size.inc((), len(_search_cache))
+    menu_cache_size = _Metric('menu_cache_stores', 'stores whose menu is cached', 'gauge')
+    menu_cache_size.inc((), len(_menu_cache))
+    for metric in [search_cache, search_cache_size, menu_cache_size]:
+        metric.render(lines)
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@bp.route("/sql-profile")
+def sql_profile():
+    '''
+    timings of statements sampled by the slow query log (SLOW_QUERY_SAMPLE), slowest in total first,
+    and the last slow ones, only answered to local requests
+    '''
+    if not _local_request():
+        return make_response('', 404)
+    with _sql_profile_lock:
+        statements = [{'statement': statement, 'count': count, 'total': total, 'mean': total / count,
+                       'longest': longest}
+                      for statement, (count, total, longest) in _sql_profile.items()]
+        slow = list(_slow_queries)
+    statements.sort(key=lambda s: s['total'], reverse=True)
+    response = jsonify({'sample': SLOW_QUERY_SAMPLE, 'threshold': SLOW_QUERY_THRESHOLD,
+                        'statements': statements, 'slow': slow})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
 
 
-@app.errorhandler(Exception)
+@bp.app_errorhandler(Exception)
 def all_exception_handler(error):
     print("**all_exception_handler**")
     print(error)
     return "invalid", 500
 
 
+def _instance_secret_key(app):
+    '''
+    random key stored in the instance folder, created by the first worker and read by the others
+    '''
+    path = os.path.join(app.instance_path, 'secret_key')
+    if not os.path.exists(path):
+        os.makedirs(app.instance_path, exist_ok=True)
+        temp = f'{path}.{os.getpid()}'
+        with open(temp, 'wb') as f:
+            f.write(os.urandom(32))
+        os.chmod(temp, 0o600)
+        try:
+            os.link(temp, path)  # atomic, fails if another worker was first
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def create_app(config=None):
+    '''
+    application factory
+    config overrides the defaults and FLASK_* environment variables (e.g. FLASK_SECRET_KEY, FLASK_DATABASE)
+    every worker must share SECRET_KEY to read sessions of the others, so without one configured
+    the key is kept in the instance folder instead of being random per process
+    doesn't touch the database: connections are made per worker on first use, see init_db for the schema
+    '''
+    app = Flask(__name__)
+    app.config.from_mapping(DATABASE=DATABASE, SECRET_KEY=None)
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = _instance_secret_key(app)
+    app.register_blueprint(bp)
+    app.teardown_appcontext(close_connection)
+    return app
+
+
+class _ThreadPoolServer(BaseWSGIServer):
+    '''
+    werkzeug server answering requests on SERVER_THREADS long-lived threads
+    app.run(threaded=True) starts a thread per request, so every request would open its own connection
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # HTTP/1.0 (set before multithread): an idle keep-alive client can't hold a thread of the pool
+        super().__init__(*args, **kwargs)
+        self.multithread = True
+        self.executor = ThreadPoolExecutor(max_workers=SERVER_THREADS, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
 def main():
-    init_db()
-    app.run('0.0.0.0', debug=True, threaded=False)
+    app = create_app()
+    init_db(app)
+    if app.debug:
+        # reloader and debugger only when asked for (FLASK_DEBUG=1), a thread and connection per request
+        app.run('0.0.0.0', threaded=True)
+        return
+    # see asgi.py for serving with an ASGI server
+    server = _ThreadPoolServer('0.0.0.0', 5000, app)
+    server.log_startup()
+    server.serve_forever()
 
 
 if __name__ == '__main__':
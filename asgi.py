@@ -0,0 +1,18 @@
+'''
+ASGI entry point, serves app.py with an ASGI server (requires a2wsgi):
+
+    flask --app app init-db
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+every request runs on one of ASGI_THREADS threads, so a slow search only holds its own thread
+while the event loop keeps accepting and answering other requests
+'''
+from a2wsgi import WSGIMiddleware
+
+import app
+
+# threads running requests, each keeps its own pooled database connection
+ASGI_THREADS = 16
+
+# lifespan events are answered by WSGIMiddleware, the database is initialized by flask init-db
+application = WSGIMiddleware(app.create_app(), workers=ASGI_THREADS)
@@ -0,0 +1,121 @@
+'''
+distance engines of search_shops: _GIO_DIS per store, unit vector dot products in SQL (SQL_DISTANCE)
+and NumPy arrays (NUMPY_DISTANCE, _StoreLocations)
+
+for every store count a temporary database is filled with stores spread around the user, then
+distances to every store, the 10 nearest stores and search_shops (near, and every store by distance)
+are timed with each engine; stores have no products and their (empty) menus are cached, so searches
+take the time of the search query and a menu cache lookup per store
+
+usage: python bench/distance.py [--stores 10000 100000 1000000] [--repeat 5]
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import app  # noqa: E402
+
+USER = (24.78, 121.0)
+SPREAD = 10  # degree around the user
+SEARCH = {'shop': '', 'price_low': '0', 'price_high': '1000', 'meal': '', 'category': '',
+          'U_lat': str(USER[0]), 'U_lon': str(USER[1]), 'desc': 'false'}
+BATCH = 100000
+
+
+def seed(flask_app, stores):
+    with flask_app.app_context():
+        db = app.get_db()
+        db.execute('''
+            insert into Users (U_account, U_password, U_name, U_type, U_latitude, U_longitude, U_phone, U_balance)
+            values ('owner', '', 'bench owner', 1, 24.78, 121.0, '0912345678', 0)
+        ''')
+        random.seed(0)
+        for start in range(0, stores, BATCH):
+            locations = [(USER[0] + random.uniform(-SPREAD, SPREAD), USER[1] + random.uniform(-SPREAD, SPREAD))
+                         for _ in range(min(BATCH, stores - start))]
+            db.executemany('''
+                insert into Stores (S_name, S_latitude, S_longitude, S_phone, S_foodtype, S_owner, S_x, S_y, S_z)
+                values (?, ?, ?, '0912345678', 'food', 1, ?, ?, ?)
+            ''', [(f'store {start + i}', lat, lon, *app._unit_vector(lat, lon))
+                  for i, (lat, lon) in enumerate(locations)])
+            db.commit()
+
+
+def best(repeat, f):
+    '''
+    fastest of repeat calls of f, in ms
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def engine(name):
+    '''
+    sets SQL_DISTANCE and NUMPY_DISTANCE for an engine
+    '''
+    app.SQL_DISTANCE = name == 'sql dot product'
+    app.NUMPY_DISTANCE = name == 'numpy'
+
+
+def run(stores, repeat):
+    database = os.path.join(tempfile.mkdtemp(), 'distance.db')
+    flask_app = app.create_app({'DATABASE': database, 'SECRET_KEY': 'distance', 'TESTING': True})
+    app.init_db(flask_app)
+    start = time.perf_counter()
+    seed(flask_app, stores)
+    print(f'{stores} stores, seeded in {time.perf_counter() - start:.1f} s')
+
+    client = flask_app.test_client()
+    with flask_app.app_context():
+        db = app.get_db()
+        cursor = db.cursor()
+        x, y, z = app._unit_vector(*USER)
+        start = time.perf_counter()
+        locations = app._get_store_locations(db)
+        print(f'    numpy arrays of {len(locations)} stores loaded in {(time.perf_counter() - start) * 1000:.0f} ms')
+        queries = {
+            'udf': (lambda: cursor.execute(
+                        "select SID, _GIO_DIS(S_latitude, S_longitude, ?, ?) from Stores", USER).fetchall(),
+                    lambda: cursor.execute('''
+                        select SID from Stores order by cast(_GIO_DIS(S_latitude, S_longitude, ?, ?) as real)
+                        limit 10''', USER).fetchall()),
+            'sql dot product': (lambda: cursor.execute(
+                                    "select SID, S_x * ? + S_y * ? + S_z * ? from Stores", (x, y, z)).fetchall(),
+                                lambda: cursor.execute('''
+                                    select SID from Stores order by S_x * ? + S_y * ? + S_z * ? desc
+                                    limit 10''', (x, y, z)).fetchall()),
+            'numpy': (lambda: locations.buckets(*USER), lambda: locations.nearest(*USER, 10)),
+        }
+        print(f'    {"engine":<18}{"all ms":>9}{"top 10 ms":>11}{"near ms":>10}{"by dist ms":>12}')
+        for name, (distances, nearest) in queries.items():
+            engine(name)
+            searches = [best(repeat, lambda: client.post('/search-shops', data=dict(
+                SEARCH, sel1=sel1, ordering=ordering))) for sel1, ordering in [('near', 'S_name'), ('%', 'manhattan')]]
+            print(f'    {name:<18}{best(repeat, distances):>9.1f}{best(repeat, nearest):>11.1f}'
+                  + ''.join(f'{ms:>{width}.1f}' for ms, width in zip(searches, [10, 12])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if app.numpy is None:
+        sys.exit('NumPy is not installed')
+    app.SEARCH_CACHE_TTL = 0
+    app.MENU_CACHE_SIZE = max(args.stores)
+    for stores in args.stores:
+        run(stores, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
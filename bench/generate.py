@@ -0,0 +1,204 @@
+'''
+synthetic data generator, fills a database with users, stores, products and order histories
+
+stores and users are clustered around a few city centers, product images are JPEGs of about --image-kb
+(random bytes if Pillow is not installed), orders have Order_Items, Process_Order and Transaction_Record
+rows like the ones order_made, order-delete and order-complete write
+every account has the password "pw": customers are user0, user1, ..., shop owners owner0, owner1, ...
+
+usage: python bench/generate.py [--database HWDB.db] [--users 10000] [--stores 2000] [--products 8]
+                                [--orders 50000] [--clusters 12] [--image-kb 20] [--seed 0]
+'''
+import io
+import os
+import sys
+import math
+import base64
+import random
+import hashlib
+import argparse
+import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import app  # noqa: E402
+
+PASSWORD = 'pw'
+# city centers are drawn from this box, stores and users are spread around them
+AREA = {'lat': (22.0, 25.3), 'lon': (120.0, 121.9)}
+CLUSTER_SPREAD = 0.05  # degree, standard deviation around a center
+FOODTYPES = ['noodles', 'dumplings', 'pizza', 'burgers', 'fast food', 'sushi', 'ramen', 'hot pot', 'bubble tea',
+             'coffee', 'bakery', 'vegetarian', 'curry', 'bento', 'dessert', 'breakfast']
+MEALS = ['beef noodles', 'fried rice', 'dumplings', 'pork bun', 'milk tea', 'black coffee', 'cheese pizza',
+         'chicken burger', 'fries', 'salmon sushi', 'miso ramen', 'green curry', 'chicken bento', 'waffle',
+         'spring rolls', 'tofu soup', 'egg pancake', 'mango ice', 'fried chicken', 'latte']
+# share of orders by O_status
+STATUS = {1: 0.7, -1: 0.1, 0: 0.2}
+BATCH = 10000
+
+
+def password(account):
+    return hashlib.sha256((PASSWORD + account).encode()).hexdigest()
+
+
+def make_images(count, kb):
+    '''
+    count (raw image, imagetype, variants) of about kb KiB, variants as _make_image_variants makes them
+    '''
+    images = []
+    for _ in range(count):
+        if app.Image is None:
+            images.append((os.urandom(kb * 1024), 'jpeg', []))
+            continue
+        # noise barely compresses, so the size follows the number of pixels
+        side = 128
+        for _ in range(3):
+            img = app.Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+            output = io.BytesIO()
+            img.save(output, 'JPEG', quality=85)
+            side = max(16, int(side * math.sqrt(kb * 1024 / len(output.getvalue()))))
+        raw = output.getvalue()
+        variants = [(variant, *app._resize_image(raw, variant)) for variant in app.IMAGE_VARIANTS]
+        images.append((raw, 'jpeg', [(variant, data, imagetype, app._image_hash(data))
+                                     for variant, data, imagetype in variants]))
+    return images
+
+
+def location(center):
+    return random.gauss(center[0], CLUSTER_SPREAD), random.gauss(center[1], CLUSTER_SPREAD)
+
+
+def generate(db, args):
+    random.seed(args.seed)
+    centers = [(random.uniform(*AREA['lat']), random.uniform(*AREA['lon'])) for _ in range(args.clusters)]
+    images = [(base64.b64encode(raw), imagetype, app._image_hash(raw), variants)
+              for raw, imagetype, variants in make_images(16, args.image_kb)]
+
+    # customers, then one owner per store
+    customers = []
+    for i in range(args.users):
+        cluster = random.randrange(args.clusters)
+        customers.append((f'user{i}', cluster, *location(centers[cluster])))
+    db.executemany('''
+        insert into Users (U_account, U_password, U_name, U_type, U_latitude, U_longitude, U_phone, U_balance)
+        values (?, ?, 'Bench User', 0, ?, ?, '0912345678', 10000000)
+    ''', [(account, password(account), lat, lon) for account, _, lat, lon in customers])
+    first_owner = db.execute("select max(UID) from Users").fetchone()[0] + 1
+    db.executemany('''
+        insert into Users (U_account, U_password, U_name, U_type, U_latitude, U_longitude, U_phone, U_balance)
+        values (?, ?, 'Bench Owner', 1, ?, ?, '0912345678', 0)
+    ''', [(f'owner{i}', password(f'owner{i}'), *centers[0]) for i in range(args.stores)])
+
+    stores = []  # (SID, owner UID, lat, lon, menu: [(PID, P_name, P_price, P_imagetype, listing image hash)])
+    by_cluster = [[] for _ in centers]
+    for i in range(args.stores):
+        cluster = random.randrange(args.clusters)
+        lat, lon = location(centers[cluster])
+        SID = db.execute('''
+            insert into Stores (S_name, S_latitude, S_longitude, S_phone, S_foodtype, S_owner, S_x, S_y, S_z)
+            values (?, ?, ?, '0912345678', ?, ?, ?, ?, ?)
+        ''', (f'{random.choice(FOODTYPES)} shop {i}', lat, lon, random.choice(FOODTYPES), first_owner + i,
+              *app._unit_vector(lat, lon))).lastrowid
+        stores.append((SID, first_owner + i, lat, lon, []))
+        by_cluster[cluster].append(stores[-1])
+    db.execute("update Users set U_latitude = S_latitude, U_longitude = S_longitude from Stores where UID = S_owner")
+
+    # products, a store has 1 to 2 * --products of them
+    for SID, owner, _, _, menu in stores:
+        for name in random.sample(MEALS, min(len(MEALS), random.randint(1, 2 * args.products))):
+            encoded, imagetype, digest, variants = random.choice(images)
+            price = random.randint(3, 60) * 5
+            PID = db.execute('''
+                insert into Products (P_name, P_price, P_quantity, P_image, P_imagetype, P_image_hash,
+                    P_thumb_hash, P_owner, P_store)
+                values (?, ?, 1000000, ?, ?, ?, ?, ?, ?)
+            ''', (name, price, encoded, imagetype, digest, variants[0][3] if variants else None, owner, SID)).lastrowid
+            db.executemany('''
+                insert into Product_Images (PID, PI_variant, PI_image, PI_imagetype, PI_hash)
+                values (?, ?, ?, ?, ?)
+            ''', [(PID, *variant) for variant in variants])
+            menu.append((PID, name, price, imagetype, variants[0][3] if variants else digest))
+    db.commit()
+    print(f'{args.users} customers, {args.stores} stores, '
+          f'{sum(len(s[4]) for s in stores)} products in {args.clusters} clusters')
+
+    # orders of customers at stores of their cluster, over the last --days days
+    now = datetime.datetime.now()
+    statuses, weights = list(STATUS), list(STATUS.values())
+    for start in range(0, args.orders, BATCH):
+        orders, items, processes, transactions = [], [], [], []
+        OID = (db.execute("select max(OID) from Orders").fetchone()[0] or 0) + 1
+        for OID in range(OID, OID + min(BATCH, args.orders - start)):
+            account, cluster, lat, lon = random.choice(customers)
+            UID = int(account[4:]) + 1  # customers were inserted first into an empty database
+            SID, owner, S_lat, S_lon, menu = random.choice(by_cluster[cluster] or stores)
+            ordered = random.sample(menu, random.randint(1, min(3, len(menu))))
+            quantities = [random.randint(1, 3) for _ in ordered]
+            distance = float(app._distance_between_locations(lat, lon, S_lat, S_lon))
+            O_type = random.randint(0, 1)
+            Delivery_fee = max(int(round(distance * 10)), 10) if O_type else 0
+            Subtotal = sum(price * q for (_, _, price, _, _), q in zip(ordered, quantities))
+            Total = Subtotal + Delivery_fee
+            status = random.choices(statuses, weights)[0]
+            start_time = now - datetime.timedelta(seconds=random.uniform(0, args.days * 86400))
+            end_time = start_time + datetime.timedelta(minutes=random.uniform(10, 60)) if status == 1 else None
+            details = app._dump_order_details(Subtotal, Delivery_fee, [[PID, digest, imagetype]
+                                                                        for PID, _, _, imagetype, digest in ordered])
+            orders.append((OID, status, start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                           end_time and end_time.strftime('%Y-%m-%d %H:%M:%S'),
+                           distance, Total, O_type, details, SID))
+            items += [(OID, PID, name, price, q) for (PID, name, price, _, _), q in zip(ordered, quantities)]
+            processes.append((UID, OID, {0: 0, 1: 2, -1: random.choice([1, 3])}[status]))
+            T_time = orders[-1][2]
+            transactions += [(0, -Total, 0, T_time, UID, owner), (1, Total, 0, T_time, owner, UID)]
+            if status == -1:
+                transactions += [(1, Total, 1, T_time, UID, owner), (0, -Total, 1, T_time, owner, UID)]
+        db.executemany('''
+            insert into Orders (OID, O_status, O_start_time, O_end_time, O_distance, O_amount, O_type, O_details, SID)
+            values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', orders)
+        db.executemany('''
+            insert into Order_Items (OID, PID, OI_name, OI_price, OI_quantity)
+            values (?, ?, ?, ?, ?)
+        ''', items)
+        db.executemany("insert into Process_Order (UID, OID, PO_type) values (?, ?, ?)", processes)
+        db.executemany('''
+            insert into Transaction_Record (T_action, T_amount, is_refund, T_time, T_Subject, T_Object)
+            values (?, ?, ?, ?, ?, ?)
+        ''', sorted(transactions, key=lambda t: t[3]))
+        db.commit()
+    print(f'{args.orders} orders over {args.days} days')
+
+    # shop owners earned the orders they didn't refund
+    db.execute('''
+        update Users
+        set U_balance = (select coalesce(sum(T_amount), 0) from Transaction_Record where T_Subject = UID)
+        where U_type = 1
+    ''')
+    db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=os.path.join(ROOT, app.DATABASE))
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--stores', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=8, help='average products per store')
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=90, help='orders are spread over this many days')
+    parser.add_argument('--clusters', type=int, default=12)
+    parser.add_argument('--image-kb', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.database):
+        sys.exit(f'{args.database} exists, remove it or choose another --database')
+
+    flask_app = app.create_app({'DATABASE': args.database, 'SECRET_KEY': 'generate'})
+    app.init_db(flask_app)
+    with flask_app.app_context():
+        generate(app.get_db(), args)
+    print(f'{args.database}: {os.path.getsize(args.database) / 1024 / 1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
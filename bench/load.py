@@ -0,0 +1,189 @@
+'''
+end-to-end load benchmark, replays a mix of requests through the Flask test client
+
+runs on a database made by bench/generate.py (a small one is generated in a temporary directory
+if --database isn't given); every thread is a customer that logs in and keeps sending requests picked by
+MIX weights, order-complete is sent by the owner of a store with an unfinished order
+prints latency percentiles and throughput of every endpoint
+
+usage: python bench/load.py [--database HWDB.db] [--threads 4] [--seconds 10] [--no-search-cache]
+'''
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import contextlib
+import tempfile
+import threading
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import app  # noqa: E402
+import generate  # noqa: E402
+
+# relative frequency of each request
+MIX = {'login': 5, 'search-shops': 45, 'order_preview': 15, 'order_made': 10, 'search-MyOrders': 15,
+       'order-complete': 10}
+# database generated when --database isn't given
+SMALL = ['--users', '1000', '--stores', '300', '--orders', '5000', '--image-kb', '10']
+
+
+class Customer:
+    '''
+    a logged in customer, remembers the menu of its last search and its last order preview
+    '''
+
+    def __init__(self, flask_app, database, account, latitude, longitude, record):
+        self.flask_app, self.account, self.location = flask_app, account, (latitude, longitude)
+        self.db = sqlite3.connect(database)
+        self.record = record
+        self.owners = {}  # shop owner account -> logged in client
+        self.menu, self.preview = [], None
+        self.login()
+
+    def request(self, endpoint, client, method, path, failed=None, **kwargs):
+        '''
+        records the latency of a request, it failed if its status is an error or failed(response) is true
+        '''
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        latency = time.perf_counter() - start
+        self.record(endpoint, latency, response.status_code >= 400 or bool(failed and failed(response)))
+        return response
+
+    def login(self):
+        self.client = self.flask_app.test_client()
+        self.request('login', self.client, 'POST', '/login', data={'Account': self.account, 'password': 'pw'})
+        self.UID = self.client.get('/get_session').get_json()['user_info']['UID']
+
+    def search(self):
+        lat, lon = self.location
+        form = {'shop': '', 'sel1': random.choice(['near', 'near', 'medium', '%']), 'price_low': '0',
+                'price_high': random.choice(['1000', '200', '100']),
+                'meal': random.choice(generate.MEALS)[:random.choice([2, 4, 20])] if random.random() < 0.3 else '',
+                'category': random.choice(generate.FOODTYPES) if random.random() < 0.2 else '',
+                # a few metres around the customer
+                'U_lat': str(lat + random.uniform(-0.0005, 0.0005)),
+                'U_lon': str(lon + random.uniform(-0.0005, 0.0005)),
+                'ordering': random.choice(list(app.SHOP_ORDERING)), 'desc': random.choice(['true', 'false'])}
+        response = self.request('search-shops', self.client, 'POST', '/search-shops', data=form)
+        shops = response.get_json()['tableRow']
+        if shops:
+            self.menu = random.choice(shops[:10])['menu']
+
+    def order_preview(self):
+        if not self.menu:
+            return self.search()
+        products = random.sample(self.menu, random.randint(1, min(3, len(self.menu))))
+        form = {'PIDs': [p['PID'] for p in products], 'Quantities': [str(random.randint(1, 2)) for _ in products],
+                'Dilivery': random.choice(['0', '1'])}
+        response = self.request('order_preview', self.client, 'POST', '/order_preview', data=form)
+        self.preview = form, response.get_json()
+
+    def order_made(self):
+        if self.preview is None:
+            return self.order_preview()
+        form, preview = self.preview
+        self.preview = None
+        self.request('order_made', self.client, 'POST', '/order_made', json={
+            'PIDs': form['PIDs'], 'Quantities': form['Quantities'], 'S_owner': preview['S_owner'],
+            'Type': form['Dilivery']}, failed=lambda r: r.get_json()['message'].startswith('Failed'))
+
+    def my_orders(self):
+        self.request('search-MyOrders', self.client, 'POST', '/search-MyOrders', data={'UID': self.UID})
+
+    def complete(self):
+        # an unfinished order after a random one
+        last = self.db.execute("select max(OID) from Orders").fetchone()[0]
+        rst = self.db.execute('''
+            select OID, U_account
+            from Orders natural join Stores join Users on UID = S_owner
+            where OID >= ? and O_status = 0
+            order by OID
+            limit 1
+        ''', (random.randint(1, last), )).fetchone()
+        if rst is None:
+            return
+        OID, account = rst
+        owner = self.owners.get(account)
+        if owner is None:
+            owner = self.owners[account] = self.flask_app.test_client()
+            owner.post('/login', data={'Account': account, 'password': 'pw'})
+        self.request('order-complete', owner, 'POST', '/order-complete', data={'OID': OID})
+
+
+def run(flask_app, database, threads, seconds):
+    '''
+    returns {endpoint: ([latency], errors)} of threads customers sending requests for seconds
+    '''
+    results = collections.defaultdict(lambda: ([], [0]))
+    lock = threading.Lock()
+
+    def record(endpoint, latency, error):
+        with lock:
+            results[endpoint][0].append(latency)
+            results[endpoint][1][0] += error
+
+    db = sqlite3.connect(database)
+    accounts = db.execute("select U_account, U_latitude, U_longitude from Users where U_type = 0").fetchall()
+    actions = {'login': Customer.login, 'search-shops': Customer.search, 'order_preview': Customer.order_preview,
+               'order_made': Customer.order_made, 'search-MyOrders': Customer.my_orders,
+               'order-complete': Customer.complete}
+    deadline = time.perf_counter() + seconds
+
+    def customer(seed):
+        rng = random.Random(seed)
+        user = Customer(flask_app, database, *rng.choice(accounts), record)
+        while time.perf_counter() < deadline:
+            actions[rng.choices(list(MIX), list(MIX.values()))[0]](user)
+
+    workers = [threading.Thread(target=customer, args=(i, )) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return {endpoint: (latencies, errors[0]) for endpoint, (latencies, errors) in results.items()}
+
+
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help='made by bench/generate.py, requests change it')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--no-search-cache', action='store_true', help='set SEARCH_CACHE_TTL to 0')
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(), 'load.db')
+        sys.argv[1:] = ['--database', database] + SMALL
+        generate.main()
+    if args.no_search_cache:
+        app.SEARCH_CACHE_TTL = 0
+    flask_app = app.create_app({'DATABASE': database, 'SECRET_KEY': 'load'})
+    app.init_db(flask_app)
+
+    # handlers print some of the requests they get
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        results = run(flask_app, database, args.threads, args.seconds)
+    print(f'{"endpoint":<18}{"requests":>9}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"errors":>8}')
+    for endpoint in MIX:
+        latencies, errors = results.get(endpoint, ([], 0))
+        if not latencies:
+            continue
+        latencies.sort()
+        print(f'{endpoint:<18}{len(latencies):>9}{len(latencies) / args.seconds:>9.1f}'
+              + ''.join(f'{percentile(latencies, q) * 1000:>9.1f}' for q in (0.5, 0.95, 0.99)) + f'{errors:>8}')
+    total = sum(len(latencies) for latencies, _ in results.values())
+    print(f'{total} requests, {total / args.seconds:.1f} requests/s with {args.threads} threads')
+
+
+if __name__ == '__main__':
+    main()
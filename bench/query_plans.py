@@ -0,0 +1,168 @@
+'''
+query plan regression check
+
+drives every handler through the Flask test client on a small temporary database,
+records the SQL they run, and prints EXPLAIN QUERY PLAN of each statement
+exits with status 1 when a statement scans a whole table without an index
+
+usage: python bench/query_plans.py [--verbose]
+'''
+import io
+import os
+import re
+import sys
+import base64
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+# 1x1 png
+IMAGE = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC')
+
+# full scans that are expected, (table, substring of the statement)
+ALLOWED_SCANS = [
+    # ordering search results by distance has to compute the distance of every store,
+    # and may list every product of them
+    ('Stores', 'from Stores natural left join dis'),
+    ('Products', 'from Stores natural left join dis'),
+]
+
+QUERY = re.compile(r'\s*(select|insert|update|delete|with)\b', re.IGNORECASE)
+SCAN = re.compile(r'^SCAN (\w+)')
+
+
+def record_statements(statements):
+    '''
+    every connection opened from now on appends the SQL it runs to statements
+    '''
+    connect = app._connect
+
+    def _connect(database):
+        db = connect(database)
+        db.set_trace_callback(statements.append)
+        return db
+    app._connect = _connect
+
+
+def drive_handlers(flask_app):
+    '''
+    calls every handler that runs SQL at least once
+    '''
+    client, owner = flask_app.test_client(), flask_app.test_client()
+    app.SEARCH_CACHE_TTL = 0  # every search runs its queries
+
+    def register(c, account, latitude, longitude):
+        c.post('/register-account-check', data={'Account': account})
+        c.post('/register', data={'name': 'plan check', 'phonenumber': '0912345678', 'Account': account,
+                                  'password': 'pw', 're-password': 'pw',
+                                  'latitude': latitude, 'longitude': longitude})
+        c.post('/login', data={'Account': account, 'password': 'pw'})
+        return c.get('/get_session').get_json()['user_info']['UID']
+
+    UID = register(client, 'customer', '24.78', '121.0')
+    owner_UID = register(owner, 'owner', '24.79', '121.01')
+    owner.post('/register-shop_name-check', data={'shop_name': 'plan shop'})
+    owner.post('/shop_register', data={'shop_name': 'plan shop', 'shop_category': 'noodles',
+                                       'shop_latitude': '24.79', 'shop_longitude': '121.01'})
+    owner.post('/login', data={'Account': 'owner', 'password': 'pw'})
+    for name in ['beef noodles', 'dumplings', 'tea']:
+        owner.post('/shop_add', data={'meal_name': name, 'meal_price': '50', 'meal_quantity': '100',
+                                      'meal_pic': (io.BytesIO(IMAGE), 'meal.png')},
+                   content_type='multipart/form-data')
+    owner.get('/nav.html')
+    client.get('/nav.html')
+    client.post('/top_up', data={'value': '1000'})
+    client.post('/edit_location', data={'latitude': '24.781', 'longitude': '121.001'})
+
+    form = {'shop': '', 'sel1': '%', 'price_low': '0', 'price_high': '1000', 'meal': '', 'category': '',
+            'U_lat': '24.78', 'U_lon': '121.0', 'ordering': 'S_name', 'desc': 'false'}
+    searches = [{}, {'sel1': 'near'}, {'sel1': 'medium'}, {'sel1': 'far'}, {'ordering': 'manhattan'},
+                {'shop': 'plan', 'category': 'nood', 'meal': 'beef'}, {'shop': 'pl', 'meal': 'te'}]
+    for search in searches:
+        client.post('/search-shops', data=dict(form, **search))
+    client.post('/nearest-shops', data={'K': '2', 'category': 'nood', 'meal': 'beef', 'price_high': '100'})
+    client.post('/nearest-shops', data={'U_lat': '24.78', 'U_lon': '121.0', 'shop': 'pl', 'meal': 'te'})
+    rst = client.post('/search-shops', data=form).get_json()['tableRow']
+    menu = [(m['PID'], m['P_image_url']) for shop in rst for m in shop['menu']]
+    PIDs = [PID for PID, _ in menu]
+    client.get(menu[0][1])
+    # the other search_shops mode, and search_menu without its cache
+    single_pass, cache_size = app.SEARCH_SINGLE_PASS, app.MENU_CACHE_SIZE
+    app.SEARCH_SINGLE_PASS = not single_pass
+    client.post('/search-shops', data=dict(form, meal='beef'))
+    app.SEARCH_SINGLE_PASS, app.MENU_CACHE_SIZE = False, 0
+    client.post('/search-shops', data=dict(form, meal='beef'))
+    app.SEARCH_SINGLE_PASS, app.MENU_CACHE_SIZE = single_pass, cache_size
+
+    preview = client.post('/order_preview', data={'PIDs': PIDs, 'Quantities': ['1'] * len(PIDs),
+                                                  'Dilivery': '1'}).get_json()
+    order = {'PIDs': PIDs, 'Quantities': [1] * len(PIDs), 'S_owner': preview['S_owner'], 'Type': '1'}
+    client.post('/order_made', json=order)
+    client.post('/order_made', json=order)
+    OIDs = [r['OID'] for r in client.post('/search-MyOrders', data={'UID': UID}).get_json()['tableRow']]
+    client.post('/order-detail', data={'OID': OIDs[0]})
+    owner.post('/search-ShopOrders', data={'UID': owner_UID})
+    client.post('/order-delete', data={'OID': OIDs[0], 'is_shopowner': 'false'})
+    owner.post('/order-complete', data={'OID': OIDs[1]})
+    client.post('/search-transactionRecord', data={'UID': UID})
+    owner.post('/search-transactionRecord', data={'UID': owner_UID})
+
+    owner.post('/edit_price_and_quantity', data={'edit_price': '60', 'edit_quantity': '10', 'edit_PID': PIDs[0]})
+    owner.post('/delete_product', data={'delete_PID': PIDs[-1]})
+    client.post('/logout')
+
+
+def full_scans(db, plan, statement):
+    '''
+    tables plan scans without an index, except ALLOWED_SCANS
+    '''
+    tables = db.cursor().execute(
+        "select name from sqlite_master where type = 'table' and sql not like 'CREATE VIRTUAL TABLE%'"
+    ).fetchall()
+    tables = {name for (name, ) in tables}
+    scans = []
+    for (detail, ) in plan:
+        match = SCAN.match(detail)
+        if match is None or match.group(1) not in tables:
+            continue  # index scans, virtual tables and subqueries
+        if any(match.group(1) == table and text in statement for table, text in ALLOWED_SCANS):
+            continue
+        scans.append(detail)
+    return scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--verbose', action='store_true', help='print the plan of every statement')
+    args = parser.parse_args()
+
+    flask_app = app.create_app({'DATABASE': os.path.join(tempfile.mkdtemp(), 'plans.db'), 'SECRET_KEY': 'plans',
+                                'TESTING': True})
+    statements = []
+    record_statements(statements)
+    app.init_db(flask_app)
+    del statements[:]  # migrations
+    drive_handlers(flask_app)
+
+    # statements of triggers are traced as comments
+    queries = {s.strip(): None for s in statements if QUERY.match(s)}
+    failed = 0
+    with flask_app.app_context():
+        db = app.get_db()
+        for statement in queries:
+            plan = db.cursor().execute('explain query plan ' + statement).fetchall()
+            plan = [(detail, ) for _, _, _, detail in plan]
+            scans = full_scans(db, plan, statement)
+            if scans or args.verbose:
+                print(' '.join(statement.split())[:200])
+                for (detail, ) in plan:
+                    print('   ', detail, '<- full scan' if detail in scans else '')
+            failed += bool(scans)
+    print(f'{len(queries)} statements, {failed} with full scans')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
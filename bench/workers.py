@@ -0,0 +1,147 @@
+'''
+measures how throughput scales with the number of gunicorn workers (prefork, see gunicorn.conf.py)
+
+for every worker count a server is started on a temporary database, then client processes
+log in and keep sending searches, nav.html and order history requests for a few seconds;
+sessions must be readable by every worker, so a request redirected to the login page counts as an error
+
+usage: python bench/workers.py [--workers 1 2 4] [--clients 8] [--seconds 5] [--stores 2000]
+'''
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import tempfile
+import subprocess
+import http.client
+import urllib.parse
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import app  # noqa: E402
+
+PORT = 5099
+SEARCH = {'shop': '', 'sel1': 'near', 'price_low': '0', 'price_high': '1000', 'meal': '', 'category': '',
+          'U_lat': '24.78', 'U_lon': '121.0', 'ordering': 'S_name', 'desc': 'false'}
+
+
+def seed(database, stores):
+    '''
+    stores around the clients, each with a few products, and a user per client
+    '''
+    flask_app = app.create_app({'DATABASE': database, 'SECRET_KEY': 'seed'})
+    app.init_db(flask_app)
+    with flask_app.app_context():
+        db = app.get_db()
+        random.seed(0)
+        db.executemany('''
+            insert into Users (U_account, U_password, U_name, U_type, U_latitude, U_longitude, U_phone, U_balance)
+            values (?, ?, 'bench user', ?, 24.78, 121.0, '0912345678', 1000000)
+        ''', [(f'owner{i}', '', 1) for i in range(stores)])
+        locations = [(24.78 + random.uniform(-10, 10), 121.0 + random.uniform(-10, 10)) for _ in range(stores)]
+        db.executemany('''
+            insert into Stores (S_name, S_latitude, S_longitude, S_phone, S_foodtype, S_owner, S_x, S_y, S_z)
+            values (?, ?, ?, '0912345678', 'food', ?, ?, ?, ?)
+        ''', [(f'store {i}', lat, lon, i + 1, *app._unit_vector(lat, lon)) for i, (lat, lon) in enumerate(locations)])
+        db.executemany('''
+            insert into Products (P_name, P_price, P_quantity, P_image, P_imagetype, P_image_hash, P_owner, P_store)
+            values (?, ?, 100, '', 'png', '', ?, ?)
+        ''', [(f'meal {j}', random.randint(10, 200), i + 1, i + 1) for i in range(stores) for j in range(5)])
+        db.commit()
+
+
+def register(account):
+    request('POST', '/register', {'name': 'bench client', 'phonenumber': '0912345678', 'Account': account,
+                                  'password': 'pw', 're-password': 'pw', 'latitude': '24.78', 'longitude': '121.0'})
+
+
+def request(method, path, form=None, cookie=None):
+    connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=30)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    if cookie:
+        headers['Cookie'] = cookie
+    connection.request(method, path, urllib.parse.urlencode(form or {}), headers)
+    response = connection.getresponse()
+    response.body = response.read()
+    connection.close()
+    return response
+
+
+def client(account, deadline, results):
+    response = request('POST', '/login', {'Account': account, 'password': 'pw'})
+    cookie = response.getheader('Set-Cookie').split(';')[0]
+    UID = json.loads(request('GET', '/get_session', None, cookie).body)['user_info']['UID']
+    latencies, errors = [], 0
+    while time.perf_counter() < deadline:
+        kind = random.random()
+        start = time.perf_counter()
+        if kind < 0.6:
+            response = request('POST', '/search-shops', SEARCH, cookie)
+        elif kind < 0.8:
+            response = request('GET', '/nav.html', None, cookie)
+        else:
+            response = request('POST', '/search-MyOrders', {'UID': UID}, cookie)
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors += 1  # e.g. nav.html redirected to login: session not readable by this worker
+    results.put((latencies, errors))
+
+
+def run(workers, clients, seconds, database):
+    env = dict(os.environ, FLASK_DATABASE=database, FLASK_SECRET_KEY='bench', WEB_CONCURRENCY=str(workers),
+               BIND=f'127.0.0.1:{PORT}')
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', '--log-level', 'warning', 'wsgi:application'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                request('GET', '/')
+                break
+            except OSError:
+                time.sleep(0.1)
+        for i in range(clients):
+            register(f'client{i}')
+
+        results = multiprocessing.Queue()
+        deadline = time.perf_counter() + seconds
+        processes = [multiprocessing.Process(target=client, args=(f'client{i}', deadline, results))
+                     for i in range(clients)]
+        for p in processes:
+            p.start()
+        latencies, errors = [], 0
+        for _ in processes:
+            l, e = results.get()
+            latencies += l
+            errors += e
+        for p in processes:
+            p.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    latencies.sort()
+    p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+    print(f'{workers:>3} workers: {len(latencies) / seconds:8.1f} requests/s, p50 {p50 * 1000:6.1f} ms, '
+          f'p95 {p95 * 1000:6.1f} ms, {errors} errors')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, os.cpu_count() or 1, 2 * (os.cpu_count() or 1)}))
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--stores', type=int, default=2000)
+    args = parser.parse_args()
+    for workers in args.workers:
+        database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        seed(database, args.stores)
+        run(workers, args.clients, args.seconds, database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+measures write throughput of write_transaction while readers keep searching
+
+modes:
+    serialized  WAL + single writer thread with group commits (SERIALIZED_WRITES)
+    direct      WAL, every thread writes on its own connection (default setup)
+    rollback    rollback journal, every thread writes on its own connection (old setup)
+
+usage: python bench/write_throughput.py [--writers 8] [--readers 4] [--seconds 5] [--mode serialized ...]
+'''
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+MODES = {
+    'serialized': (True, {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}),
+    'direct': (False, {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}),
+    'rollback': (False, {'journal_mode': 'DELETE', 'synchronous': 'FULL'}),
+}
+
+
+def top_up(db, UID):
+    # same statements as the /top_up handler
+    db.cursor().execute('update Users set U_balance = U_balance + ? where UID = ?', (1, UID))
+    db.cursor().execute('''
+        insert into Transaction_Record(T_action, T_amount, T_Subject, T_Object)
+        values (?, ?, ?, ?)
+    ''', (2, 1, UID, UID))
+
+
+def run(mode, writers, readers, seconds):
+    app.SERIALIZED_WRITES, pragmas = MODES[mode]
+    app.SQLITE_PRAGMAS.update(pragmas)
+    flask_app = app.create_app({'DATABASE': os.path.join(tempfile.mkdtemp(), 'bench.db'), 'SECRET_KEY': 'bench'})
+    app.init_db(flask_app)
+    with flask_app.app_context():
+        db = app.get_db()
+        db.executemany('''
+            insert into Users (U_account, U_password, U_name, U_type, U_latitude, U_longitude, U_phone, U_balance)
+            values (?, '', 'bench user', 0, 0, 0, '0000000000', 0)
+        ''', [(f'bench{i}', ) for i in range(writers)])
+        db.commit()
+
+    counts = {'writes': 0, 'write_errors': 0, 'reads': 0, 'read_errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def writer(UID):
+        done = errors = 0
+        with flask_app.app_context():
+            while time.perf_counter() < deadline:
+                try:
+                    app.write_transaction(top_up, UID)
+                    done += 1
+                except sqlite3.OperationalError:
+                    errors += 1
+        with lock:
+            counts['writes'] += done
+            counts['write_errors'] += errors
+
+    def reader():
+        db = app._pooled_connection(flask_app.config['DATABASE'])
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            try:
+                db.execute('select count(*), sum(U_balance) from Users').fetchone()
+                done += 1
+            except sqlite3.OperationalError:
+                errors += 1
+        with lock:
+            counts['reads'] += done
+            counts['read_errors'] += errors
+
+    threads = [threading.Thread(target=writer, args=(UID, )) for UID in range(1, writers + 1)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"{mode:>10}: {counts['writes'] / seconds:9.1f} writes/s, {counts['write_errors']} write errors, "
+          f"{counts['reads'] / seconds:9.1f} reads/s, {counts['read_errors']} read errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--mode', choices=MODES, action='append')
+    args = parser.parse_args()
+    for mode in args.mode or MODES:
+        run(mode, args.writers, args.readers, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
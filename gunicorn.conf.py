@@ -0,0 +1,16 @@
+'''
+gunicorn settings: gunicorn -c gunicorn.conf.py wsgi:application
+'''
+import os
+import multiprocessing
+
+import app
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+# a worker per core, more are set with WEB_CONCURRENCY
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+
+def on_starting(server):
+    # once in the master, before any worker starts
+    app.init_db(app.create_app())
@@ -1,3 +1,5 @@
+-- schema of database version 1, changes after it are MIGRATIONS in app.py
+
 CREATE TABLE
     if NOT EXISTS Users(
         UID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -86,10 +88,127 @@ CREATE TABLE
         P_image BLOB NOT NULL,
         -- image encoded by base64
         P_imagetype VARCHAR(25) NOT NULL,
+        P_image_hash VARCHAR(64) NOT NULL,
+        -- sha256 of the decoded image, part of the image url
+        P_thumb_hash VARCHAR(64),
+        -- sha256 of the thumbnail in Product_Images, NULL until it is made,
+        -- P_image_hash if the image can't be resized
         P_owner INT NOT NULL,
         P_store INT NOT NULL,
         FOREIGN key (P_owner) REFERENCES Users(UID),
         FOREIGN key (P_store) REFERENCES Stores(SID),
         -- constraints --
         CONSTRAINT P_quantity_non_negative CHECK (P_quantity >= 0)
-    );
\ No newline at end of file
+    );
+
+CREATE TABLE
+    if NOT EXISTS Product_Images(
+        PID INT NOT NULL,
+        PI_variant VARCHAR(10) NOT NULL,
+        -- 'thumb', see IMAGE_VARIANTS in app.py
+        PI_image BLOB NOT NULL,
+        -- raw image, not base64 encoded
+        PI_imagetype VARCHAR(25) NOT NULL,
+        PI_hash VARCHAR(64) NOT NULL,
+        PRIMARY key (PID, PI_variant),
+        FOREIGN key (PID) REFERENCES Products(PID) ON DELETE CASCADE
+    );
+
+CREATE VIRTUAL TABLE
+    if NOT EXISTS Stores_rtree USING rtree(
+        SID,
+        min_lat, max_lat,
+        min_lon, max_lon
+        -- stores are points, so min == max
+    );
+
+-- keep Stores_rtree in sync with Stores
+CREATE TRIGGER
+    if NOT EXISTS Stores_rtree_insert AFTER INSERT ON Stores
+    BEGIN
+        INSERT INTO Stores_rtree
+        VALUES (NEW.SID, NEW.S_latitude, NEW.S_latitude, NEW.S_longitude, NEW.S_longitude);
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Stores_rtree_update AFTER UPDATE OF S_latitude, S_longitude ON Stores
+    BEGIN
+        UPDATE Stores_rtree
+        SET min_lat = NEW.S_latitude, max_lat = NEW.S_latitude,
+            min_lon = NEW.S_longitude, max_lon = NEW.S_longitude
+        WHERE SID = NEW.SID;
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Stores_rtree_delete AFTER DELETE ON Stores
+    BEGIN
+        DELETE FROM Stores_rtree WHERE SID = OLD.SID;
+    END;
+
+-- index stores created before Stores_rtree existed
+INSERT INTO Stores_rtree
+    SELECT SID, S_latitude, S_latitude, S_longitude, S_longitude
+    FROM Stores
+    WHERE SID NOT IN (SELECT SID FROM Stores_rtree);
+
+-- trigram indexes for substring search, see _text_filter in app.py
+CREATE VIRTUAL TABLE
+    if NOT EXISTS Stores_fts USING fts5(
+        S_name, S_foodtype,
+        content = 'Stores', content_rowid = 'SID',
+        tokenize = 'trigram'
+    );
+
+CREATE VIRTUAL TABLE
+    if NOT EXISTS Products_fts USING fts5(
+        P_name,
+        content = 'Products', content_rowid = 'PID',
+        tokenize = 'trigram'
+    );
+
+-- keep Stores_fts and Products_fts in sync with their content tables
+CREATE TRIGGER
+    if NOT EXISTS Stores_fts_insert AFTER INSERT ON Stores
+    BEGIN
+        INSERT INTO Stores_fts(rowid, S_name, S_foodtype)
+        VALUES (NEW.SID, NEW.S_name, NEW.S_foodtype);
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Stores_fts_update AFTER UPDATE OF S_name, S_foodtype ON Stores
+    BEGIN
+        INSERT INTO Stores_fts(Stores_fts, rowid, S_name, S_foodtype)
+        VALUES ('delete', OLD.SID, OLD.S_name, OLD.S_foodtype);
+        INSERT INTO Stores_fts(rowid, S_name, S_foodtype)
+        VALUES (NEW.SID, NEW.S_name, NEW.S_foodtype);
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Stores_fts_delete AFTER DELETE ON Stores
+    BEGIN
+        INSERT INTO Stores_fts(Stores_fts, rowid, S_name, S_foodtype)
+        VALUES ('delete', OLD.SID, OLD.S_name, OLD.S_foodtype);
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Products_fts_insert AFTER INSERT ON Products
+    BEGIN
+        INSERT INTO Products_fts(rowid, P_name)
+        VALUES (NEW.PID, NEW.P_name);
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Products_fts_update AFTER UPDATE OF P_name ON Products
+    BEGIN
+        INSERT INTO Products_fts(Products_fts, rowid, P_name)
+        VALUES ('delete', OLD.PID, OLD.P_name);
+        INSERT INTO Products_fts(rowid, P_name)
+        VALUES (NEW.PID, NEW.P_name);
+    END;
+
+CREATE TRIGGER
+    if NOT EXISTS Products_fts_delete AFTER DELETE ON Products
+    BEGIN
+        INSERT INTO Products_fts(Products_fts, rowid, P_name)
+        VALUES ('delete', OLD.PID, OLD.P_name);
+    END;
@@ -0,0 +1,8 @@
+'''
+WSGI entry point for prefork servers, e.g. with gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+'''
+from app import create_app
+
+application = create_app()